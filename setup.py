@@ -41,6 +41,6 @@ setup(
        'pyworkflow.plugin': 'xmipp2 = xmipp2',
     },
     package_data={  # Optional
-       'xmipp2': ['xmipp_logo.png', 'protocols.conf'],
+       'xmipp2': ['xmipp_logo.png', 'protocols.conf', 'mock/bin/*'],
     }
 )
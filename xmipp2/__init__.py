@@ -28,9 +28,10 @@
 This package contains the protocols and data for xmipp 2.4
 """
 import os
+import sys
 import pwem
 from pyworkflow.utils import Environ
-from .constants import XMIPP2_HOME
+from .constants import XMIPP2_HOME, XMIPP2_MOCK
 
 __version__ = '3.0.1'
 
@@ -42,6 +43,7 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(XMIPP2_HOME, "Xmipp-2.4-src")
+        cls._defineVar(XMIPP2_MOCK, '0')
 
 
     @classmethod
@@ -54,8 +56,28 @@ class Plugin(pwem.Plugin):
             'LD_LIBRARY_PATH': os.path.join(cls.getVar(XMIPP2_HOME),'lib'),
         }, position=Environ.BEGIN)
 
+        if cls.useMock():
+            # The mock programs take precedence over the ones in XMIPP2_HOME
+            environ.update({
+                'PATH': os.path.join(os.path.dirname(__file__), 'mock', 'bin'),
+                'PYTHONPATH': os.path.dirname(os.path.dirname(__file__)),
+            }, position=Environ.BEGIN)
+            environ['XMIPP2_MOCK_PYTHON'] = sys.executable
+
         return environ
 
+    @classmethod
+    def useMock(cls):
+        """ True if the mock programs of xmipp2/mock must be run instead of Xmipp 2.4. """
+        return str(cls.getVar(XMIPP2_MOCK)).lower() in ['1', 'true', 'yes']
+
+    @classmethod
+    def validateInstallation(cls):
+        """ Xmipp 2.4 does not need to be installed when its mock programs are used. """
+        if cls.useMock():
+            return []
+        return super().validateInstallation()
+
     @classmethod
     def isVersionActive(cls):
         return cls.getActiveVersion().startswith("")
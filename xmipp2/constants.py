@@ -28,6 +28,12 @@
 
 XMIPP2_HOME = "XMIPP2_HOME"
 
+# If set to 1, the protocols run the mock programs of xmipp2/mock instead of Xmipp 2.4
+XMIPP2_MOCK = "XMIPP2_MOCK"
+
+# Folder in the project Tmp with the converted volumes shared between MLTomo runs
+VOLUME_CACHE = "xmipp2VolumeCache"
+
 # Supported versions:
 
 # This is the same dogpicker version but made compatible with PILLOW update
@@ -28,129 +28,641 @@ This module contains converter functions that will serve to:
 1. Write from base classes to Xmipp2.4 specific files
 2. Read from Xmipp2.4 files to base classes
 """
-import math
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import numpy as np
+from pyworkflow.utils.path import createLink
 from pwem.objects import Transform
 from pwem.emlib.image import ImageHandler
 
+_OBJID_REGEX = re.compile(r'(\d+)\.\w+$')
+
+# Columns of the MLTomo docfiles
+DOC_DTYPE = np.dtype([('id', int), ('rot', float), ('tilt', float), ('psi', float),
+                      ('xoff', float), ('yoff', float), ('zoff', float), ('ref', int),
+                      ('wedge', int), ('pmax', float), ('ll', float)])
+DOC_CHUNK_SIZE = 100000
+# Extensions of the files that Xmipp 2.4 reads as Spider volumes
+SPIDER_EXTENSIONS = ('.vol', '.spi')
+
 
 def writeVolume(volume, outputFn):
     ih = ImageHandler()
     ih.convert(volume, "%s" % outputFn)
 
-def writeSetOfVolumes(setOfVolumes, outputFnRoot):
-    ih = ImageHandler()
+def writeSetOfVolumes(setOfVolumes, outputFnRoot, numberOfProcs=1, cache=None, fnSel=None, fnDoc=None, wedge=0,
+                      downscale=None):
+    """ Convert the volumes to Spider files named outputFnRoot + objId (%06d) + .vol.
+    Volumes that are already Spider files are linked instead of converted, and if a
+    VolumeCache is given, converted files are reused from (and added to) it.
+    If downscale is given, the volumes are Fourier cropped to that dimension (see
+    fourierCrop) and the shifts written to the docfile are scaled accordingly.
+    If numberOfProcs > 1 the conversion is done by a pool of processes. An exception
+    reporting every failed file is raised at the end if any of them could not be converted.
+    The set is iterated only once: the sel file (fnSel) and the MLTomo docfile (fnDoc) with
+    the transforms and classes of the volumes are written from the same pass. wedge is the
+    wedge index of all the volumes, or a function returning the wedge index of a volume. """
+    tasks = []
+    objIds = []
+    matrices = []
+    classIds = []
+    wedges = []
+    scale = None
     for volume in setOfVolumes:
-        i = volume.getObjId()
-        ih.convert(volume, "%s%06d.vol"%(outputFnRoot,i))
+        objId = volume.getObjId()
+        tasks.append((volume.getLocation(), "%s%06d.vol" % (outputFnRoot, objId), cache, downscale))
+        if fnDoc is not None:
+            objIds.append(objId)
+            wedges.append(wedge(volume) if callable(wedge) else wedge)
+            transform = volume.getTransform()
+            if transform is None:
+                matrices.append(np.identity(4))
+                classIds.append(0)
+            else:
+                matrix = np.array(transform.getMatrix())
+                if downscale:
+                    scale = scale or float(downscale) / volume.getXDim()
+                    matrix[:3, 3] *= scale
+                matrices.append(matrix)
+                classId = volume.getClassId()
+                classIds.append(0 if classId is None else classId)
+    if numberOfProcs > 1 and len(tasks) > 1:
+        chunkSize = max(1, min(64, len(tasks) // (4 * numberOfProcs)))
+        with ProcessPoolExecutor(max_workers=numberOfProcs) as executor:
+            errors = [error for error in executor.map(_convertVolume, tasks, chunksize=chunkSize) if error]
+    else:
+        errors = [error for error in map(_convertVolume, tasks) if error]
+    if cache is not None:
+        cache.evict()
+    if errors:
+        raise Exception("%d of %d volumes could not be converted:\n%s" % (len(errors), len(tasks), '\n'.join(errors)))
+    fileNames = [task[1] for task in tasks]
+    if fnSel is not None:
+        with open(fnSel, 'w') as fhSel:
+            fhSel.writelines("%s 1\n" % fn for fn in fileNames)
+    if fnDoc is not None:
+        with open(fnDoc, 'w') as fhDoc:
+            writeDocfile(fhDoc, fileNames, objIds, np.array(matrices).reshape(-1, 4, 4), classIds, wedges)
+
+def _convertVolume(task):
+    """ Convert a single volume, return None on success or an error message. """
+    location, outputFn, cache, downscale = task
+    try:
+        if downscale:
+            if cache is not None:
+                cache.convert(location, outputFn, downscale)
+            else:
+                downscaleVolume(location, outputFn, downscale)
+        elif isSpiderVolume(location):
+            if os.path.lexists(outputFn):
+                os.remove(outputFn)
+            createLink(location[1], outputFn)
+        elif cache is not None:
+            cache.convert(location, outputFn)
+        else:
+            ImageHandler().convert(location, outputFn)
+    except Exception as e:
+        return "%s -> %s: %s" % (location, outputFn, e)
+
+def isSpiderVolume(location):
+    """ True if the location (index, filename) is a file with a single Spider volume,
+    that can be used by Xmipp 2.4 without any conversion. """
+    index, fn = location
+    if os.path.splitext(fn)[1] not in SPIDER_EXTENSIONS or index > 1:
+        return False
+    return ImageHandler().getDimensions(fn)[3] == 1
+
+def fourierCrop(data, dim):
+    """ Downscale a volume (3D array) to dim^3 voxels keeping the Fourier coefficients
+    below the new Nyquist frequency. The mean value of the volume is preserved. """
+    half = dim // 2
+    ft = np.fft.rfftn(data)
+    indexes = [np.r_[0:dim - half, n - half:n] for n in data.shape[:2]] + [np.arange(half + 1)]
+    cropped = ft[np.ix_(*indexes)]
+    return (np.fft.irfftn(cropped, s=(dim, dim, dim)) * (dim ** 3 / float(data.size))).astype(np.float32)
+
+def fourierPad(data, dim):
+    """ Upscale a volume (3D array) to dim^3 voxels padding its Fourier transform with
+    zeros, the inverse of fourierCrop. The mean value of the volume is preserved. """
+    n = data.shape[0]
+    half = n // 2
+    padded = np.zeros((dim, dim, dim // 2 + 1), dtype=complex)
+    indexes = [np.r_[0:n - half, dim - half:dim]] * 2 + [np.arange(half + 1)]
+    padded[np.ix_(*indexes)] = np.fft.rfftn(data)
+    return (np.fft.irfftn(padded, s=(dim, dim, dim)) * (dim ** 3 / float(data.size))).astype(np.float32)
+
+def resizeVolume(location, outputFn, dim):
+    """ Write to the Spider file outputFn the volume at location Fourier cropped or padded to dim. """
+    ih = ImageHandler()
+    data = ih.read(location).getData().astype(np.float64)
+    image = ih.createImage()
+    image.setData(fourierCrop(data, dim) if dim < data.shape[0] else fourierPad(data, dim))
+    image.write(outputFn)
+
+def downscaleVolume(location, outputFn, dim):
+    """ Write to the Spider file outputFn the volume at location Fourier cropped to dim. """
+    ih = ImageHandler()
+    image = ih.createImage()
+    image.setData(fourierCrop(ih.read(location).getData().astype(np.float64), dim))
+    image.write(outputFn)
+
+def getDownscaledDim(dim, samplingRate, resolution):
+    """ Smallest even dimension (not larger than dim) to which volumes of dim voxels at
+    samplingRate (A/px) can be Fourier cropped keeping frequencies up to resolution (A). """
+    newDim = int(np.ceil(2. * dim * samplingRate / resolution))
+    return min(dim, newDim + newDim % 2)
+
+
+class VolumeCache:
+    """ Content-addressed cache of converted Spider volumes, shared between protocol runs.
+    Entries are named after the hash of the source file content and the index of the volume
+    in it. When the cache grows over maxSize bytes, the least recently used entries are evicted.
+    Converted volumes are hard linked from the cache, so they do not take disk space twice. """
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        os.makedirs(path, exist_ok=True)
+
+    def getEntry(self, location, downscale=None):
+        index, fn = location
+        st = os.stat(fn)
+        entry = '%s_%d' % (_fileDigest(fn, st.st_size, st.st_mtime), index)
+        if downscale:
+            entry += '_%d' % downscale
+        return os.path.join(self.path, entry + '.vol')
+
+    def convert(self, location, outputFn, downscale=None):
+        """ Write the volume at location in outputFn, converting it (and downscaling it to
+        downscale voxels, if given) only if it is not in the cache. """
+        entry = self.getEntry(location, downscale)
+        try:
+            os.utime(entry)
+            _linkOrCopy(entry, outputFn)
+            return
+        except FileNotFoundError:
+            # Not in the cache, or evicted meanwhile by another run sharing it
+            pass
+        tmpEntry = '%s.%d.tmp' % (entry, os.getpid())
+        if downscale:
+            downscaleVolume(location, tmpEntry, downscale)
+        else:
+            ImageHandler().convert(location, tmpEntry)
+        # Linked before it is in the cache, so it can not be evicted in between
+        _linkOrCopy(tmpEntry, outputFn)
+        os.replace(tmpEntry, entry)
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache size is below maxSize. """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.vol'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another run sharing the cache
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for _, entrySize, fn in sorted(entries):
+            if size <= self.maxSize:
+                break
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+
+@lru_cache(maxsize=1024)
+def _fileDigest(fn, size, mtime):
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _linkOrCopy(source, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+class VolumeHistory:
+    """ Compact store of the references and wedges of the MLTomo iterations. The volumes of
+    each iteration are kept in a compressed npz file (mltomo_itNNNNNN.npz, with arrays named
+    as refNNNNNN and wedgeNNNNNN) in a reduced precision, and index.json records the
+    iterations, their references and the volume shape. Volumes are loaded one at a time
+    and only when read. """
+
+    INDEX = 'index.json'
+
+    def __init__(self, path, dtype=np.float16):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._index = None
+
+    def getIndex(self):
+        """ {iteration: {'file', 'refs', 'wedges', 'shape', 'dtype'}}, reloaded if it changed. """
+        fnIndex = os.path.join(self.path, self.INDEX)
+        if not os.path.exists(fnIndex):
+            return {}
+        mtime = os.path.getmtime(fnIndex)
+        if self._index is None or self._index[0] != mtime:
+            with open(fnIndex) as fhIndex:
+                self._index = (mtime, {int(it): entry for it, entry in json.load(fhIndex).items()})
+        return self._index[1]
+
+    def getIterations(self):
+        return sorted(self.getIndex())
+
+    def getReferences(self, iteration):
+        return self.getIndex()[iteration]['refs']
+
+    def __contains__(self, key):
+        """ Whether an iteration, or an (iteration, reference) volume, is stored. """
+        iteration, ref = key if isinstance(key, tuple) else (key, None)
+        entry = self.getIndex().get(iteration)
+        return entry is not None and (ref is None or ref in entry['refs'])
+
+    def add(self, iteration, refs, wedges=None):
+        """ Store the volumes of an iteration, given as {reference: filename} dicts. """
+        ih = ImageHandler()
+        arrays = {}
+        shape = None
+        for kind, volumes in [('ref', refs), ('wedge', wedges or {})]:
+            for ref, fn in volumes.items():
+                data = ih.read(fn).getData()
+                shape = data.shape
+                arrays['%s%06d' % (kind, ref)] = data.astype(self.dtype)
+        os.makedirs(self.path, exist_ok=True)
+        fnVolumes = 'mltomo_it%06d.npz' % iteration
+        fnTmp = os.path.join(self.path, fnVolumes + '.tmp')
+        with open(fnTmp, 'wb') as fh:
+            np.savez_compressed(fh, **arrays)
+        os.replace(fnTmp, os.path.join(self.path, fnVolumes))
+        index = {str(it): entry for it, entry in self.getIndex().items()}
+        index[str(iteration)] = {'file': fnVolumes, 'refs': sorted(refs), 'wedges': sorted(wedges or {}),
+                                 'shape': list(shape or []), 'dtype': self.dtype.name}
+        fnIndex = os.path.join(self.path, self.INDEX)
+        with open(fnIndex + '.tmp', 'w') as fhIndex:
+            json.dump(index, fhIndex, indent=1)
+        os.replace(fnIndex + '.tmp', fnIndex)
+
+    def read(self, iteration, ref, kind='ref'):
+        """ Volume (float32 array) of a reference (kind 'ref') or its wedge (kind 'wedge')
+        in an iteration. Only that volume is decompressed. """
+        entry = self.getIndex()[iteration]
+        with np.load(os.path.join(self.path, entry['file'])) as volumes:
+            return volumes['%s%06d' % (kind, ref)].astype(np.float32)
+
+def readHistoryVolume(path, iteration, ref, kind='ref'):
+    """ Read a volume of the VolumeHistory in path, see VolumeHistory.read. """
+    return VolumeHistory(path).read(iteration, ref, kind)
 
 def eulerAngles2matrix(alpha, beta, gamma, shiftx, shifty, shiftz):
-    A = np.empty([4,4])
-    A.fill(2)
-    A[3,3] = 1
-    A[3,0:3] = 0
-    A[0,3] = float(shiftx)
-    A[1,3] = float(shifty)
-    A[2,3] = float(shiftz)
-    alpha = float(alpha)
-    beta = float(beta)
-    gamma = float(gamma)
-    sa = np.sin(np.deg2rad(alpha))
-    ca = np.cos(np.deg2rad(alpha))
-    sb = np.sin(np.deg2rad(beta))
-    cb = np.cos(np.deg2rad(beta))
-    sg = np.sin(np.deg2rad(gamma))
-    cg = np.cos(np.deg2rad(gamma))
+    return eulerAngles2matrixBatch([float(alpha)], [float(beta)], [float(gamma)],
+                                   [float(shiftx)], [float(shifty)], [float(shiftz)])[0]
+
+def eulerAngles2matrixBatch(alpha, beta, gamma, shiftx, shifty, shiftz):
+    """ Vectorized version of eulerAngles2matrix. Angles (in degrees) and shifts
+    are (N,) arrays and a (N,4,4) stack of transformation matrices is returned. """
+    alpha = np.deg2rad(np.asarray(alpha, dtype=float))
+    beta = np.deg2rad(np.asarray(beta, dtype=float))
+    gamma = np.deg2rad(np.asarray(gamma, dtype=float))
+    A = np.zeros((alpha.size, 4, 4))
+    A[:, 3, 3] = 1
+    A[:, 0, 3] = shiftx
+    A[:, 1, 3] = shifty
+    A[:, 2, 3] = shiftz
+    sa = np.sin(alpha)
+    ca = np.cos(alpha)
+    sb = np.sin(beta)
+    cb = np.cos(beta)
+    sg = np.sin(gamma)
+    cg = np.cos(gamma)
     cc = cb * ca
     cs = cb * sa
     sc = sb * ca
     ss = sb * sa
-    A[0,0] = cg * cc - sg * sa
-    A[0,1] = cg * cs + sg * ca
-    A[0,2] = -cg * sb
-    A[1,0] = -sg * cc - cg * sa
-    A[1,1] = -sg * cs + cg * ca
-    A[1,2] = sg * sb
-    A[2,0] = sc
-    A[2,1] = ss
-    A[2,2] = cb
+    A[:, 0, 0] = cg * cc - sg * sa
+    A[:, 0, 1] = cg * cs + sg * ca
+    A[:, 0, 2] = -cg * sb
+    A[:, 1, 0] = -sg * cc - cg * sa
+    A[:, 1, 1] = -sg * cs + cg * ca
+    A[:, 1, 2] = sg * sb
+    A[:, 2, 0] = sc
+    A[:, 2, 1] = ss
+    A[:, 2, 2] = cb
     return A
 
 def matrix2eulerAngles(A):
-    abs_sb = np.sqrt(A[0, 2] * A[0, 2] + A[1, 2] * A[1, 2])
-    if (abs_sb > 16*np.exp(-5)):
-        gamma = math.atan2(A[1, 2], -A[0, 2])
-        alpha = math.atan2(A[2, 1], A[2, 0])
-        if (abs(np.sin(gamma)) < np.exp(-5)):
-            sign_sb = np.sign(-A[0, 2] / np.cos(gamma))
-        else:
-            if np.sin(gamma) > 0:
-                sign_sb = np.sign(A[1, 2])
-            else:
-                sign_sb = -np.sign(A[1, 2])
-        beta = math.atan2(sign_sb * abs_sb, A[2, 2])
-    else:
-        if (np.sign(A[2, 2]) > 0):
-            alpha = 0
-            beta  = 0
-            gamma = math.atan2(-A[1, 0], A[0, 0])
-        else:
-            alpha = 0
-            beta  = np.pi
-            gamma = math.atan2(A[1, 0], -A[0, 0])
-    gamma = np.rad2deg(gamma)
-    beta  = np.rad2deg(beta)
-    alpha = np.rad2deg(alpha)
-    return alpha, beta, gamma, A[0,3], A[1,3], A[2,3]
+    angles = matrix2eulerAnglesBatch(np.asarray(A)[np.newaxis])
+    return tuple(x[0] for x in angles)
 
+def matrix2eulerAnglesBatch(A):
+    """ Vectorized version of matrix2eulerAngles. It receives a (N,4,4) stack of
+    transformation matrices and returns the (N,) arrays alpha, beta, gamma (in degrees)
+    and shiftx, shifty, shiftz. """
+    A = np.asarray(A, dtype=float)
+    abs_sb = np.sqrt(A[:, 0, 2] * A[:, 0, 2] + A[:, 1, 2] * A[:, 1, 2])
+    regular = abs_sb > 16*np.exp(-5)
+    # Regular case
+    gamma = np.arctan2(A[:, 1, 2], -A[:, 0, 2])
+    alpha = np.arctan2(A[:, 2, 1], A[:, 2, 0])
+    sin_g = np.sin(gamma)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sign_sb = np.where(np.abs(sin_g) < np.exp(-5),
+                           np.sign(-A[:, 0, 2] / np.cos(gamma)),
+                           np.where(sin_g > 0, np.sign(A[:, 1, 2]), -np.sign(A[:, 1, 2])))
+    beta = np.arctan2(sign_sb * abs_sb, A[:, 2, 2])
+    # Gimbal lock: rotation around Z only, beta is either 0 or pi
+    positive = np.sign(A[:, 2, 2]) > 0
+    gammaLock = np.where(positive, np.arctan2(-A[:, 1, 0], A[:, 0, 0]), np.arctan2(A[:, 1, 0], -A[:, 0, 0]))
+    betaLock = np.where(positive, 0, np.pi)
+    alpha = np.where(regular, alpha, 0)
+    beta = np.where(regular, beta, betaLock)
+    gamma = np.where(regular, gamma, gammaLock)
+    return (np.rad2deg(alpha), np.rad2deg(beta), np.rad2deg(gamma),
+            A[:, 0, 3].copy(), A[:, 1, 3].copy(), A[:, 2, 3].copy())
+
+
+def iterDocfile(fnDoc, chunkSize=DOC_CHUNK_SIZE):
+    """ Iterate over a MLTomo docfile (e.g. mltomo_it000015.doc) in chunks of at most
+    chunkSize rows. Each chunk is a structured array with DOC_DTYPE fields. The id of
+    each row is the objId encoded in the image name preceding it, or the docfile key
+    when the name does not contain it. """
+    ids = []
+    lines = []
+    imgName = None
+    with open(fnDoc) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(';'):
+                imgName = line[1:].strip()
+                continue
+            objId = getObjIdFromFileName(imgName) if imgName else None
+            ids.append(int(line.split(None, 1)[0]) if objId is None else objId)
+            lines.append(line)
+            imgName = None
+            if len(lines) == chunkSize:
+                yield _parseDocLines(ids, lines)
+                ids = []
+                lines = []
+    if lines or chunkSize is None:
+        yield _parseDocLines(ids, lines)
+
+def _parseDocLines(ids, lines):
+    if not lines:
+        # A docfile with only the header, e.g. that of an empty shard
+        return np.empty(0, dtype=DOC_DTYPE)
+    values = np.array(' '.join(lines).split(), dtype=float).reshape(len(lines), -1)
+    data = np.empty(len(lines), dtype=DOC_DTYPE)
+    data['id'] = ids
+    for i, name in enumerate(DOC_DTYPE.names[1:]):
+        data[name] = values[:, i + 2]
+    return data
+
+def readDocfileArray(fnDoc, mmap=False):
+    """ Read a whole MLTomo docfile into a structured array (see iterDocfile).
+    If mmap is True, the parsed array is cached in a .npy file next to the docfile
+    and returned memory-mapped, so later reads do not parse the docfile again. """
+    if mmap:
+        fnCache = fnDoc + '.npy'
+        if not os.path.exists(fnCache) or os.path.getmtime(fnCache) < os.path.getmtime(fnDoc):
+            np.save(fnCache, readDocfileArray(fnDoc))
+        return np.load(fnCache, mmap_mode='r')
+    return next(iterDocfile(fnDoc, chunkSize=None))
+
+def docfileMatrices(data):
+    """ Transformation matrices, a (N,4,4) stack, of the rows of a docfile array. """
+    # MLTomo offsets have the opposite sign
+    return eulerAngles2matrixBatch(data['rot'], data['tilt'], data['psi'], -data['xoff'], -data['yoff'], -data['zoff'])
 
 def readDocfile(self, item):
-    nline = self.docFile.readline()
-    if nline.startswith(' ;'):
-        nline = self.docFile.readline()
-    if nline.startswith(' ;'):
-        nline = self.docFile.readline()
-    nline = nline.rstrip()
-    id = int(nline.split()[0])
-    if (item.getObjId() == id):
-        rot = nline.split()[2]
-        tilt = nline.split()[3]
-        psi = nline.split()[4]
-        shiftx = nline.split()[5]
-        if shiftx.startswith('-'):
-            shiftx = shiftx[1:]
-        else:
-            shiftx = '-' + shiftx
-        shifty = nline.split()[6]
-        if shifty.startswith('-'):
-            shifty = shifty[1:]
-        else:
-            shifty = '-' + shifty
-        shiftz = nline.split()[7]
-        if shiftz.startswith('-'):
-            shiftz = shiftz[1:]
-        else:
-            shiftz = '-' + shiftz
-        refId = float(nline.split()[8])
-        A = eulerAngles2matrix(rot, tilt, psi, shiftx, shifty, shiftz)
-        transform = Transform()
-        transform.setMatrix(A)
-        item.setTransform(transform)
-        item.setClassId(refId)
-
-def writeDocfile(self, fhSel, fhDoc, volumes, wedge):
-    fhDoc.write(" ; Headerinfo columns: rot (1), tilt (2), psi (3), Xoff (4), Yoff (5), Zoff (6), Ref (7), Wedge (8), "
-                "Pmax/sumP (9), LL (10)\n")
-    for line in fhSel:
-        imgName = line.split()[0]
-        for vol in volumes.iterItems():
-            if ('%06d' % vol.getObjId()) in line:
-                rot, tilt, psi, xoff, yoff, zoff = matrix2eulerAngles(vol.getTransform().getMatrix())
-                xoff = xoff * (-1)
-                yoff = yoff * (-1)
-                zoff = zoff * (-1)
-                classid = vol.getClassId()
-                if classid is None:
-                    classid = 0
-                fhDoc.write(" ; %s\n%d 10 %f %f %f %f %f %f %d %d 0 0\n" % (imgName, vol.getObjId(), rot, tilt, psi,
-                                                                            xoff, yoff, zoff, classid, wedge))
+    """ Set the transform and class of item from the row with its same id in self.docData,
+    indexed by self.docIndex (objId -> row), whose matrices are in self.docMatrices (see
+    docfileMatrices). The transform of the item is updated in place if it has one. Return
+    whether the item is in the docfile and assigned to a class, otherwise it is not updated. """
+    i = self.docIndex.get(item.getObjId())
+    if i is None or self.docData['ref'][i] < 1:
+        return False
+    if item.hasTransform():
+        item.getTransform().setMatrix(self.docMatrices[i])
+    else:
+        item.setTransform(Transform(self.docMatrices[i]))
+    item.setClassId(int(self.docData['ref'][i]))
+    return True
+
+def writeDocfile(fhDoc, fileNames, objIds, matrices, classIds, wedge):
+    """ Write the MLTomo input docfile of the volumes fileNames, with their objIds, (N,4,4)
+    transformation matrices and classIds. wedge is the wedge index of the volumes, either
+    a single value for all of them or one per volume. """
+    if np.isscalar(wedge):
+        wedge = [wedge] * len(fileNames)
+    rot, tilt, psi, xoff, yoff, zoff = matrix2eulerAnglesBatch(matrices)
+    lines = [" ; Headerinfo columns: rot (1), tilt (2), psi (3), Xoff (4), Yoff (5), Zoff (6), Ref (7), Wedge (8), "
+             "Pmax/sumP (9), LL (10)\n"]
+    for i, imgName in enumerate(fileNames):
+        lines.append(" ; %s\n%d 10 %f %f %f %f %f %f %d %d 0 0\n" % (imgName, objIds[i], rot[i], tilt[i], psi[i],
+                                                                    -xoff[i], -yoff[i], -zoff[i], classIds[i], wedge[i]))
+    fhDoc.writelines(lines)
+
+def readSelFile(fnSel):
+    """ Return the file names listed in a sel file. """
+    with open(fnSel) as fhSel:
+        return [line.split()[0] for line in fhSel if line.strip() and not line.lstrip().startswith(';')]
+
+def _readDocfileEntries(fnDoc):
+    """ Return the header of a docfile and a dict with the entry (image name comment and
+    data line) of each image name. """
+    header = []
+    entries = {}
+    imgName = None
+    with open(fnDoc) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            if line.lstrip().startswith(';'):
+                if 'Headerinfo' in line:
+                    header.append(line)
+                else:
+                    imgName = line
+                continue
+            entries[imgName.lstrip()[1:].strip()] = (imgName, line)
+    return header, entries
+
+def splitDocfile(fnSel, fnDoc, fnShards):
+    """ Split the volumes of a sel file into len(fnShards) contiguous shards of similar size.
+    fnShards is a list of (sel, doc) file names to write for each shard, the doc file with
+    the entries of fnDoc of the volumes in the shard. """
+    fileNames = readSelFile(fnSel)
+    header, entries = _readDocfileEntries(fnDoc)
+    shards = np.array_split(np.arange(len(fileNames)), len(fnShards))
+    for (fnShardSel, fnShardDoc), shard in zip(fnShards, shards):
+        with open(fnShardSel, 'w') as fhSel:
+            fhSel.writelines("%s 1\n" % fileNames[i] for i in shard)
+        with open(fnShardDoc, 'w') as fhDoc:
+            fhDoc.writelines(header)
+            fhDoc.writelines(''.join(entries[fileNames[i]]) for i in shard)
+
+def mergeDocfiles(fnDocs, fnSel, fnOut):
+    """ Write to fnOut the entries of the docfiles fnDocs (e.g. those of the shards of an
+    iteration) in the order of the volumes of fnSel, numbering their keys again. """
+    header = []
+    entries = {}
+    for fnDoc in fnDocs:
+        docHeader, docEntries = _readDocfileEntries(fnDoc)
+        header = header or docHeader
+        entries.update(docEntries)
+    with open(fnOut, 'w') as fhDoc:
+        fhDoc.writelines(header)
+        for key, fileName in enumerate(readSelFile(fnSel), 1):
+            imgName, line = entries[fileName]
+            fhDoc.write("%s%5d %s" % (imgName, key, line.split(None, 1)[1]))
+
+def mergeVolumes(fnVols, weights, fnOut):
+    """ Write to fnOut the weighted average of the volumes fnVols, e.g. the references of
+    the shards weighted by their number of particles. All the volumes weigh the same if
+    the weights add up to zero. """
+    weights = np.asarray(weights, dtype=float)
+    if not weights.sum():
+        weights = np.ones(len(fnVols))
+    ih = ImageHandler()
+    average = sum(w * ih.read(fnVol).getData().astype(np.float64) for w, fnVol in zip(weights, fnVols) if w)
+    image = ih.createImage()
+    image.setData((average / weights.sum()).astype(np.float32))
+    image.write(fnOut)
+
+def getObjIdFromFileName(fileName):
+    """ Return the objId encoded in the name of a converted volume (e.g. subtomo000012.vol),
+    or None if the name does not end with a number. """
+    match = _OBJID_REGEX.search(os.path.basename(fileName))
+    return int(match.group(1)) if match else None
+
+def iterationStats(data, previous=None, angularStep=None):
+    """ Statistics of a MLTomo iteration from its docfile array (see readDocfileArray):
+    mean LL, distribution of Pmax/sumP, class occupancy and, given the docfile array of the
+    previous iteration, the fraction of particles that changed class, the median angular
+    change and, if angularStep is given, the fraction of particles that changed orientation
+    by more than angularStep degrees. """
+    refs, counts = np.unique(data['ref'], return_counts=True)
+    pmax = np.percentile(data['pmax'], [0, 25, 50, 75, 100]) if len(data) else np.zeros(5)
+    stats = {'particles': int(len(data)),
+             'meanLL': float(np.mean(data['ll'])) if len(data) else 0.,
+             'pmax': dict(zip(['min', 'q1', 'median', 'q3', 'max'], pmax.tolist())),
+             'occupancy': {str(ref): int(count) for ref, count in zip(refs.tolist(), counts.tolist())}}
+    if previous is not None:
+        _, i, j = np.intersect1d(data['id'], previous['id'], assume_unique=True, return_indices=True)
+        stats['changedClass'] = float(np.mean(data['ref'][i] != previous['ref'][j])) if len(i) else 0.
+        angles = angularDistance(data[i], previous[j])
+        stats['medianAngleChange'] = float(np.median(angles)) if len(i) else 0.
+        if angularStep:
+            stats['changedOrientation'] = float(np.mean(angles > angularStep)) if len(i) else 0.
+    return stats
+
+def classStatistics(data):
+    """ Size, mean Pmax/sumP and mean LL of each class of a MLTomo docfile array (see
+    readDocfileArray), as {ref: {'size', 'meanPmax', 'meanLL'}}. Empty classes are not included. """
+    refs, index, counts = np.unique(data['ref'].astype(int), return_inverse=True, return_counts=True)
+    sumPmax = np.bincount(index, weights=data['pmax'], minlength=len(refs))
+    sumLL = np.bincount(index, weights=data['ll'], minlength=len(refs))
+    return {ref: {'size': int(count), 'meanPmax': float(pmax / count), 'meanLL': float(ll / count)}
+            for ref, count, pmax, ll in zip(refs.tolist(), counts.tolist(), sumPmax.tolist(), sumLL.tolist())}
+
+def angularDistance(data1, data2):
+    """ Angle (in degrees) of the rotation between the orientations of the rows of two
+    docfile arrays with the same length. """
+    zeros = np.zeros(len(data1))
+    R1 = eulerAngles2matrixBatch(data1['rot'], data1['tilt'], data1['psi'], zeros, zeros, zeros)[:, :3, :3]
+    R2 = eulerAngles2matrixBatch(data2['rot'], data2['tilt'], data2['psi'], zeros, zeros, zeros)[:, :3, :3]
+    trace = np.einsum('nij,nij->n', R1, R2)
+    return np.rad2deg(np.arccos(np.clip((trace - 1) / 2, -1, 1)))
+
+def readFscFile(fnFsc):
+    """ Read a MLTomo FSC file (e.g. mltomo_it000015.fsc), with the frequency in the first
+    column and the FSC of each reference in the next ones. Return the (F,) frequencies and
+    the (R,F) FSC of the references. """
+    with open(fnFsc) as fh:
+        rows = [line.split() for line in fh if line.strip() and line.lstrip()[0] not in '#;']
+    values = np.array(rows, dtype=float).reshape(len(rows), -1)
+    return values[:, 0], values[:, 1:].T
+
+def mergeFscFiles(fnFscs, weights, fnOut):
+    """ Write to fnOut the FSC of each reference averaged over the FSC files fnFscs, e.g. those
+    of the shards, weighted by the (S,R) weights of each file and reference (their number of
+    particles in the class). All the files weigh the same for a reference whose weights add
+    up to zero. As each shard has fewer particles, the average underestimates the FSC of the
+    merged reference. """
+    freq, fsc = readFscFile(fnFscs[0])
+    fscs = np.array([fsc] + [readFscFile(fnFsc)[1] for fnFsc in fnFscs[1:]])
+    weights = np.asarray(weights, dtype=float).reshape(len(fnFscs), -1)
+    weights[:, weights.sum(axis=0) == 0] = 1
+    average = np.einsum('sr,srf->rf', weights, fscs) / weights.sum(axis=0)[:, None]
+    with open(fnOut, 'w') as fhFsc:
+        fhFsc.write("# freq. FSC refs 1-%d\n" % len(average))
+        for f, values in zip(freq, average.T):
+            fhFsc.write("%f %s\n" % (f, ' '.join('%f' % value for value in values)))
+
+def loadFscHistory(fnFscs, fnCache=None):
+    """ FSC of the iterations, given as {iteration: FSC file}, in (I,) iterations, (I,F)
+    frequencies and (I,R,F) FSC arrays, padded with NaN when the iterations have different
+    numbers of frequencies or references. If fnCache is given, the parsed iterations are kept
+    in that npz file with the modification time of their files, and only new or modified
+    files are parsed. Iterations in the cache whose files no longer exist are kept. """
+    entries = {}
+    if fnCache and os.path.exists(fnCache):
+        with np.load(fnCache) as cache:
+            for i, it in enumerate(cache['iterations'].tolist()):
+                numberOfRefs, numberOfFreqs = cache['shapes'][i]
+                entries[it] = (cache['mtimes'][i], cache['freq'][i, :numberOfFreqs],
+                               cache['fsc'][i, :numberOfRefs, :numberOfFreqs])
+    changed = False
+    for it, fnFsc in fnFscs.items():
+        mtime = os.path.getmtime(fnFsc)
+        if it not in entries or entries[it][0] != mtime:
+            entries[it] = (mtime,) + readFscFile(fnFsc)
+            changed = True
+    iterations = sorted(entries)
+    shapes = np.array([entries[it][2].shape for it in iterations], dtype=int).reshape(-1, 2)
+    numberOfRefs, numberOfFreqs = shapes.max(axis=0) if len(shapes) else (0, 0)
+    freq = np.full((len(iterations), numberOfFreqs), np.nan)
+    fsc = np.full((len(iterations), numberOfRefs, numberOfFreqs), np.nan)
+    for i, it in enumerate(iterations):
+        _, itFreq, itFsc = entries[it]
+        freq[i, :len(itFreq)] = itFreq
+        fsc[i, :itFsc.shape[0], :itFsc.shape[1]] = itFsc
+    if fnCache and changed:
+        # The protocol monitor and a viewer may update the cache at the same time
+        fnTmp = '%s.%d.%d.tmp' % (fnCache, os.getpid(), threading.get_ident())
+        with open(fnTmp, 'wb') as fh:
+            np.savez(fh, iterations=np.array(iterations, dtype=int), shapes=shapes, freq=freq, fsc=fsc,
+                     mtimes=np.array([entries[it][0] for it in iterations]))
+        os.replace(fnTmp, fnCache)
+    return np.array(iterations, dtype=int), freq, fsc
+
+def fscResolution(freq, fsc, threshold=0.5):
+    """ Frequency at which the FSC (..., F) drops below threshold, linearly interpolated
+    between the frequencies (..., F) around the crossing. The last valid frequency is
+    returned when the FSC does not drop below it. """
+    freq, fsc = np.broadcast_arrays(np.asarray(freq, dtype=float), np.asarray(fsc, dtype=float))
+    below = ~(fsc >= threshold)  # NaN padding counts as below
+    i = np.where(below.any(axis=-1), np.argmax(below, axis=-1), fsc.shape[-1] - 1)[..., None]
+    previous = np.maximum(i - 1, 0)
+    f0 = np.take_along_axis(freq, previous, -1)[..., 0]
+    f1 = np.take_along_axis(freq, i, -1)[..., 0]
+    c0 = np.take_along_axis(fsc, previous, -1)[..., 0]
+    c1 = np.take_along_axis(fsc, i, -1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crossing = np.where(i[..., 0] > 0, f0 + (c0 - threshold) * (f1 - f0) / (c0 - c1), f0)
+    # Without crossing, the last frequency (or the last one before the padding)
+    return np.where(c1 < threshold, crossing, np.where(np.isnan(c1), f0, f1))
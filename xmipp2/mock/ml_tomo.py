@@ -0,0 +1,158 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Mock of xmipp_ml_tomo. It accepts the arguments of the real program and writes the
+files of every iteration (docfile, sel, FSC, references and wedges) with random
+assignments and volumes, so the protocol pipeline can be run and load-tested without
+Xmipp 2.4. It is used instead of the real program when XMIPP2_MOCK is set (see
+Plugin.getEnviron) and configured with the environment variables:
+
+    XMIPP2_MOCK_DELAY: seconds each iteration takes (0 by default)
+    XMIPP2_MOCK_DIM: size of the references (by default the input size, -dim is only
+                     applied internally, to the FSC)
+    XMIPP2_MOCK_SEED: seed of the random numbers (0 by default)
+    XMIPP2_MOCK_UNASSIGNED: number of volumes, the first ones, left without class (Ref 0)
+                            in the docfiles (0 by default)
+"""
+import os
+import sys
+import time
+import numpy as np
+from pwem.emlib.image import ImageHandler
+
+from xmipp2.convert import readSelFile, readDocfileArray, DOC_DTYPE
+
+DOC_HEADER = (" ; Headerinfo columns: rot (1) , tilt (2), psi (3), Xoff (4), Yoff (5), Zoff (6), Ref (7), "
+              "Wedge (8), Pmax/sumP (9), LL (10)\n")
+
+
+def parseArgs(argv):
+    """ Return a dict of the options in argv, with None as value of the flags. """
+    args = {}
+    i = 0
+    while i < len(argv):
+        value = None
+        if i + 1 < len(argv) and not _isOption(argv[i + 1]):
+            value = argv[i + 1]
+        args[argv[i]] = value
+        i += 1 if value is None else 2
+    return args
+
+
+def _isOption(token):
+    if not token.startswith('-'):
+        return False
+    try:
+        float(token)
+        return False
+    except ValueError:
+        return True
+
+
+def writeVolumes(fileNames, dim, rng):
+    ih = ImageHandler()
+    image = ih.createImage()
+    for fn in fileNames:
+        image.setData(rng.normal(size=(dim, dim, dim)).astype(np.float32))
+        image.write(fn)
+
+
+def writeIteration(root, it, fileNames, data, numberOfRefs, dim, fscDim, rng):
+    """ Write the docfile, sel, FSC (of fscDim) and references and wedges (of dim) of iteration it. """
+    fnIter = '%s_it%06d' % (root, it)
+    fnRefs = ['%s_ref%06d.vol' % (fnIter, ref) for ref in range(1, numberOfRefs + 1)]
+    writeVolumes(fnRefs, dim, rng)
+    writeVolumes(['%s_wedge%06d.vol' % (fnIter, ref) for ref in range(1, numberOfRefs + 1)], dim, rng)
+    if it:
+        with open(fnIter + '.doc', 'w') as fhDoc:
+            fhDoc.write(DOC_HEADER)
+            for i, (fn, row) in enumerate(zip(fileNames, data), 1):
+                fhDoc.write(" ; %s\n%6d 10 %f %f %f %f %f %f %d %d %f %f\n"
+                            % (fn, i, row['rot'], row['tilt'], row['psi'], row['xoff'], row['yoff'], row['zoff'],
+                               row['ref'], row['wedge'], row['pmax'], row['ll']))
+        for ref in range(1, numberOfRefs + 1):
+            with open('%s_ref%06d.sel' % (fnIter, ref), 'w') as fhRefSel:
+                fhRefSel.writelines("%s 1\n" % fn for fn, classId in zip(fileNames, data['ref']) if classId == ref)
+        writeFsc(fnIter + '.fsc', numberOfRefs, fscDim, rng)
+    with open(fnIter + '.sel', 'w') as fhSel:
+        fhSel.writelines("%s 1\n" % fn for fn in fnRefs)
+
+
+def writeFsc(fnFsc, numberOfRefs, dim, rng):
+    """ FSC file with the frequency in the first column and the FSC of each reference in the next ones. """
+    freq = np.arange(1, dim // 2 + 1) / float(dim)
+    fsc = 1. / (1. + np.exp((freq[:, None] - rng.uniform(0.15, 0.35, numberOfRefs)) * 40))
+    with open(fnFsc, 'w') as fhFsc:
+        fhFsc.write("# freq. FSC refs 1-%d\n" % numberOfRefs)
+        for f, values in zip(freq, fsc):
+            fhFsc.write("%f %s\n" % (f, ' '.join('%f' % value for value in values)))
+
+
+def main(argv=None):
+    # When launched through mpirun, only the first process writes the outputs
+    if int(os.environ.get('OMPI_COMM_WORLD_RANK') or os.environ.get('PMI_RANK') or 0):
+        return
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    root = args['-o']
+    iStart = int(args.get('-istart') or 1)
+    iEnd = int(args.get('-iter') or 25)
+    fileNames = readSelFile(args['-i'])
+    if args.get('-ref'):
+        numberOfRefs = len(readSelFile(args['-ref'])) if args['-ref'].endswith('.sel') else 1
+    else:
+        numberOfRefs = int(args.get('-nref') or 1)
+    dim = int(os.environ.get('XMIPP2_MOCK_DIM') or ImageHandler().getDimensions(fileNames[0])[0])
+    fscDim = int(args.get('-dim') or dim)
+    delay = float(os.environ.get('XMIPP2_MOCK_DELAY') or 0)
+    unassigned = int(os.environ.get('XMIPP2_MOCK_UNASSIGNED') or 0)
+    rng = np.random.RandomState(int(os.environ.get('XMIPP2_MOCK_SEED') or 0) + iStart)
+    angularStep = float(args.get('-ang_search') or args.get('-ang') or 10)
+
+    data = readDocfileArray(args['-doc']) if args.get('-doc') else None
+    if data is None or len(data) != len(fileNames):
+        data = np.zeros(len(fileNames), dtype=DOC_DTYPE)
+        data['wedge'] = 1
+    print("Mock xmipp_ml_tomo: %d volumes, %d references of %d^3, iterations %d to %d"
+          % (len(fileNames), numberOfRefs, dim, iStart, iEnd))
+    if iStart == 1:
+        writeIteration(root, 0, fileNames, data, numberOfRefs, dim, fscDim, rng)
+    for it in range(iStart, iEnd + 1):
+        time.sleep(delay)
+        for label in ['rot', 'tilt', 'psi']:
+            data[label] += rng.normal(scale=angularStep / it, size=len(data))
+        data['ref'] = rng.randint(1, numberOfRefs + 1, size=len(data))
+        data['ref'][:unassigned] = 0
+        data['pmax'] = rng.uniform(0.1, 1, size=len(data))
+        data['ll'] = -1000. / it + rng.normal(size=len(data))
+        writeIteration(root, it, fileNames, data, numberOfRefs, dim, fscDim, rng)
+        print("Iteration %d finished" % it)
+        sys.stdout.flush()
+    writeVolumes(['%s_ref%06d.vol' % (root, ref) for ref in range(1, numberOfRefs + 1)], dim, rng)
+    writeFsc(root + '.fsc', numberOfRefs, fscDim, rng)
+
+
+if __name__ == '__main__':
+    main()
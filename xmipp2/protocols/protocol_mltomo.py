@@ -26,15 +26,61 @@
 # *
 # **************************************************************************
 
+import cProfile
+import functools
+import itertools
+import json
 import os
+import re
+import resource
+import shutil
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
+import numpy as np
 from pyworkflow import BETA
-from pyworkflow.utils.path import makePath
-from pyworkflow.protocol.params import PointerParam, BooleanParam, IntParam, StringParam, LEVEL_ADVANCED
+from pyworkflow.utils.path import makePath, cleanPath, createLink
+from pyworkflow.utils import prettySize
+from pyworkflow.object import Integer, Float, Set
+from pyworkflow.protocol.params import (PointerParam, BooleanParam, IntParam, FloatParam, StringParam, PathParam,
+                                        LEVEL_ADVANCED)
 from pwem.objects import SetOfVolumes, Volume
-from tomo.objects import AverageSubTomogram, SetOfClassesSubTomograms
+from tomo.objects import AverageSubTomogram, SetOfClassesSubTomograms, SetOfSubTomograms
 from tomo.protocols import ProtTomoSubtomogramAveraging
-from ..convert import writeVolume, writeDocfile, writeSetOfVolumes, readDocfile
+from ..convert import (writeVolume, writeSetOfVolumes, readDocfile, readDocfileArray, docfileMatrices, readSelFile,
+                       splitDocfile, mergeDocfiles, mergeVolumes, downscaleVolume, resizeVolume, getDownscaledDim,
+                       VolumeCache, VolumeHistory, iterationStats, classStatistics, mergeFscFiles,
+                       loadFscHistory)
+from ..constants import VOLUME_CACHE
+
+ANGLE_MIN = '_acquisition._angleMin'
+ANGLE_MAX = '_acquisition._angleMax'
+ITER_DOC_REGEX = re.compile(r'mltomo_it(\d{6})\.doc$')
+ITER_FILE_REGEX = re.compile(r'mltomo_it(\d{6})(?:_(ref|wedge)(\d{6}))?\.(vol|sel|doc|fsc|doc\.npy)$')
+METRICS_FILE = 'mltomo_metrics.json'
+ROUND_DIR = 'round%03d'
+VARIANT_DIR = 'variant%03d'
+SWEEP_FILE = 'sweep.json'
+STAGE_DIR = 'stage%02d'
+STEPS_FILE = 'mltomo_steps.json'
+ARCHIVE_DIR = 'archive'
+HISTORY_DIR = 'history'
+FSC_CACHE = 'mltomo_fsc.npz'
+PROFILE_DIR = 'profiles'
+
+
+def instrumented(func):
+    """ Decorator of the steps of Xmipp2ProtMLTomo to record the resources they use
+    (see StepProfiler). """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with StepProfiler(self, func.__name__, args):
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 class Xmipp2ProtMLTomo(ProtTomoSubtomogramAveraging):
@@ -49,6 +95,10 @@ class Xmipp2ProtMLTomo(ProtTomoSubtomogramAveraging):
 
     def __init__(self, **args):
         ProtTomoSubtomogramAveraging.__init__(self, **args)
+        self.convergedIteration = Integer()
+        self.streamingRound = Integer(0)
+        self.lastStreamedId = Integer(0)
+        self.missingItems = Integer(0)
 
     # --------------------------- DEFINE param functions ------------------------
     def _defineParams(self, form):
@@ -66,10 +116,64 @@ class Xmipp2ProtMLTomo(ProtTomoSubtomogramAveraging):
                       condition="randomInitialization", help="Number of references to generate automatically")
         form.addParam('numberOfIters', IntParam, label='Number of iterations', default=15,
                       help="Number of iterations to perform")
+        form.addParam('iterationsPerStep', IntParam, label='Iterations per step', default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="MLTomo is run in chunks of this number of iterations, each of them as a protocol "
+                           "step. If the protocol is stopped, \"Continue\" resumes from the last completed "
+                           "iteration, using its docfile and references.")
+        form.addParam('doEarlyStop', BooleanParam, label='Stop at convergence?', default=False,
+                      help="Stop before the number of iterations if class assignments and orientations do not "
+                           "change anymore. The criteria are evaluated between consecutive iterations at the end of "
+                           "each step (see 'Iterations per step'), criteria with a negative value are ignored.")
+        form.addParam('convClassChange', FloatParam, label='Max. fraction of class changes', default=0.01,
+                      condition="doEarlyStop",
+                      help="Converged if at most this fraction of the particles changed class")
+        form.addParam('convAngleChange', FloatParam, label='Max. median angular change (deg)', default=1.0,
+                      condition="doEarlyStop",
+                      help="Converged if the median change of orientation of the particles is below this angle")
+        form.addParam('convLLChange', FloatParam, label='Max. relative LL change', default=-1,
+                      condition="doEarlyStop",
+                      help="Converged if the relative change of the mean log-likelihood is below this value")
         form.addParam('angularSampling', IntParam, label='Angular sampling rate', default=15,
                       help="Angular sampling rate (in degrees)")
+        form.addParam('localRefinement', BooleanParam, label='Local refinement?', default=False,
+                      help="Search only the orientations and shifts close to the current alignment of each "
+                           "subtomogram instead of the whole orientation grid. The input subtomograms must have "
+                           "transforms (e.g. from a previous alignment).")
+        form.addParam('localAngularRange', FloatParam, label='Angular search range (deg)', default=20,
+                      condition="localRefinement",
+                      help="Maximum change of the orientation of each subtomogram, in degrees (-ang_search)")
+        form.addParam('localShiftRange', FloatParam, label='Shift search range (px)', default=5,
+                      condition="localRefinement",
+                      help="Maximum change of the shifts of each subtomogram, in pixels of the volumes MLTomo "
+                           "works with (-limit_trans)")
+        form.addParam('doSchedule', BooleanParam, label='Coarse-to-fine schedule?', default=False,
+                      help="Run the iterations in stages, from a coarse angular sampling at a small dimension "
+                           "to a fine sampling at full size. Each stage starts from the docfile and references "
+                           "of the last iteration of the previous one.")
+        form.addParam('stageAngularSampling', StringParam, label='Angular sampling per stage', default='15 10 5',
+                      condition="doSchedule",
+                      help="Space separated angular sampling rates (in degrees), one per stage")
+        form.addParam('stageDownscDim', StringParam, label='Dimension per stage', default='',
+                      condition="doSchedule",
+                      help="Space separated downscaled dimensions of the first stages. The stages without a "
+                           "dimension use the 'Downscaled dimension' (full size if empty).")
+        form.addParam('stageIters', StringParam, label='Iterations per stage', default='',
+                      condition="doSchedule",
+                      help="Space separated numbers of iterations of each stage, adding up to the number of "
+                           "iterations. If empty, the iterations are split evenly among the stages.")
         form.addParam('downscDim', IntParam, label='Downscaled dimension', expertLevel=LEVEL_ADVANCED, allowsNull=True,
-                      help="Use downscaled (in fourier space) images of this size")
+                      help="Use downscaled (in fourier space) images of this size. If empty and a target "
+                           "resolution is given, the smallest size that keeps that resolution is used.")
+        form.addParam('targetResolution', FloatParam, label='Target resolution (A)', expertLevel=LEVEL_ADVANCED,
+                      allowsNull=True,
+                      help="Resolution to keep when downscaling, used to suggest the downscaled dimension from "
+                           "the sampling rate of the input (see the wizard of 'Downscaled dimension')")
+        form.addParam('preDownscale', BooleanParam, label='Downscale before MLTomo?', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Fourier crop the input volumes, references and mask to the downscaled dimension "
+                           "while converting them, instead of letting MLTomo crop them in every run. Downscaled "
+                           "volumes are kept in the cache of converted volumes (see 'Reuse converted volumes?').")
         form.addParam('inputMask', PointerParam, label="Mask",
                       allowsNull=True, pointerClass='VolumeMask',
                       help='Optionally, select a mask. If a mask is used, the program will keep '
@@ -82,92 +186,391 @@ class Xmipp2ProtMLTomo(ProtTomoSubtomogramAveraging):
                       help="Keep intermediate files generated during execution once the execution is finished, this "
                            "can be useful to evaluate the progression of the results during the different iteration"
                            "but can occupy a considerable sum of disk space, specially if the input set is big.")
+        form.addParam('keepLastIters', IntParam, label='Iterations to keep while running', default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="While MLTomo runs, remove the files of the iterations older than this number of "
+                           "last iterations, so they do not fill the disk in big jobs. 0 keeps all of them.")
+        form.addParam('keepEveryIter', IntParam, label='Also keep every N iterations', default=0,
+                      condition="keepLastIters > 0", expertLevel=LEVEL_ADVANCED,
+                      help="Keep the files of the iterations multiple of this number (and the initial "
+                           "references) instead of removing them. 0 to keep only the last iterations.")
+        form.addParam('archiveKeptIters', BooleanParam, label='Archive the kept iterations?', default=False,
+                      condition="keepLastIters > 0 and keepEveryIter > 0", expertLevel=LEVEL_ADVANCED,
+                      help="Pack the files of the older iterations that are kept in a compressed archive per "
+                           "iteration, in the archive folder of extra.")
+        form.addParam('compactIterations', BooleanParam, label='Compact the iteration volumes?', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="While MLTomo runs, move the references and wedges of the finished iterations to "
+                           "compressed half precision files in the history folder of extra, removing their "
+                           "Spider files. The volumes of every iteration can then be read with "
+                           "xmipp2.convert.VolumeHistory.")
+        form.addParam('useVolumeCache', BooleanParam, label='Reuse converted volumes?', default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Keep the input volumes converted to Spider format in a cache of the project, so "
+                           "other MLTomo runs with the same subtomograms do not convert them again. Volumes "
+                           "that are already in Spider format are always linked instead of converted.")
+        form.addParam('volumeCacheSize', IntParam, label='Cache size (GB)', default=50,
+                      condition="useVolumeCache", expertLevel=LEVEL_ADVANCED,
+                      help="Maximum size of the cache of converted volumes. When it is exceeded, the least "
+                           "recently used volumes are removed from it.")
+        form.addParam('profileSteps', BooleanParam, label='Profile the steps?', default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Dump the cProfile statistics of the Python code of each step to the profiles "
+                           "folder of extra, to be inspected with pstats or snakeviz. The time, memory and I/O "
+                           "of each step are always recorded.")
+
+        form.addSection(label='Sweep')
+        form.addParam('doSweep', BooleanParam, label='Parameter sweep?', default=False,
+                      help="Convert the input once and run MLTomo with every combination of the values given "
+                           "below, each of them in its own folder (extra/variantNNN). Instead of output sets, "
+                           "the summary shows a comparison of the final mean LL, class sizes and runtime of "
+                           "the variants. An empty list uses the value of the main form.")
+        form.addParam('sweepReferences', StringParam, label='Numbers of references', default='',
+                      condition="doSweep", help="Space separated numbers of references, e.g. \"4 8 16\"")
+        form.addParam('sweepAngularSampling', StringParam, label='Angular sampling rates', default='',
+                      condition="doSweep", help="Space separated angular sampling rates (in degrees)")
+        form.addParam('sweepDownscDim', StringParam, label='Downscaled dimensions', default='',
+                      condition="doSweep", help="Space separated downscaled dimensions")
+        form.addParam('sweepMpi', IntParam, label='MPI processes per variant', default=2,
+                      condition="doSweep",
+                      help="The variants are run concurrently, as many as fit in the MPI processes of the "
+                           "protocol with this number of processes each")
+
+        form.addSection(label='Streaming')
+        form.addParam('doStreaming', BooleanParam, label='Classify in streaming?', default=False,
+                      help="Classify the input subtomograms while they are being produced. The new subtomograms "
+                           "are classified in rounds of a few iterations seeded with the references of the previous "
+                           "round, and added to the output sets as soon as each round finishes. Only the new "
+                           "subtomograms are converted and classified in each round.")
+        form.addParam('streamingBatchSize', IntParam, label='Subtomograms per round', default=1000,
+                      condition="doStreaming",
+                      help="Number of new subtomograms to wait for before running a round. When the input is "
+                           "closed, the remaining subtomograms are classified in a last round.")
+        form.addParam('streamingIters', IntParam, label='Iterations per round', default=3,
+                      condition="doStreaming", help="Number of iterations of each round")
+        form.addParam('streamingSleepOnWait', IntParam, label='Seconds between checks', default=60,
+                      condition="doStreaming", expertLevel=LEVEL_ADVANCED,
+                      help="Time to wait before checking again the input for new subtomograms")
         form.addParallelSection(threads=0, mpi=8)
+        form.addParam('numberOfShards', IntParam, label='Number of shards', default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      help="Split the subtomograms in this number of shards, run each iteration as an independent "
+                           "MLTomo job per shard and merge their references, weighted by the number of particles "
+                           "of each shard in each class. The MPI processes are distributed among the shards.")
+        form.addParam('shardHostFile', PathParam, label='Host file', allowsNull=True,
+                      condition="numberOfShards > 1", expertLevel=LEVEL_ADVANCED,
+                      help="File with the hosts where the shards are run through ssh, one per line (as in a MPI "
+                           "host file, only the first word of each line is used). The project folder must be "
+                           "shared with the hosts and Xmipp 2.4 be in their PATH. If empty, the shards are run "
+                           "as local processes.")
 
     # --------------------------- INSERT steps functions --------------------------------------------
     def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        if self.doStreaming.get():
+            self._insertFunctionStep('streamingStep')
+            return
         self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('runMLTomo')
+        if self.doSweep.get():
+            self._insertFunctionStep('sweepStep')
+            return
+        numberOfIters = self.numberOfIters.get()
+        iterationsPerStep = max(1, self.iterationsPerStep.get() or numberOfIters)
+        stages = self._getStages() if self.doSchedule.get() else [{'first': 1, 'last': numberOfIters}]
+        for stage, stageInfo in enumerate(stages, 1 if self.doSchedule.get() else 0):
+            for iStart in range(stageInfo['first'], stageInfo['last'] + 1, iterationsPerStep):
+                self._insertFunctionStep('runMLTomo', iStart, min(iStart + iterationsPerStep - 1, stageInfo['last']),
+                                         stage)
         self._insertFunctionStep('createOutput')
 
+    def _createFilenameTemplates(self):
+        """ Centralize how files are called within the protocol. The MLTomo files of a shard,
+        variant or streaming round are in their own folder, see _getDirFileName. """
+        path = self._getExtraPath()
+        myDict = {
+            'inputSel': os.path.join(path, 'subtomograms.sel'),
+            'inputDoc': os.path.join(path, 'subtomograms.doc'),
+            'wedgeDoc': os.path.join(path, 'wedge.doc'),
+            'mask': self._getExtraPath('inputVolumes', 'mask.vol'),
+            'outputRoot': os.path.join(path, 'mltomo'),
+            'iterDoc': os.path.join(path, 'mltomo_it%(iter)06d.doc'),
+            'iterSel': os.path.join(path, 'mltomo_it%(iter)06d.sel'),
+            'iterFsc': os.path.join(path, 'mltomo_it%(iter)06d.fsc'),
+            'iterRef': os.path.join(path, 'mltomo_it%(iter)06d_ref%(ref)06d.vol'),
+            'iterWedge': os.path.join(path, 'mltomo_it%(iter)06d_wedge%(ref)06d.vol'),
+            'iterRefSel': os.path.join(path, 'mltomo_it%(iter)06d_ref%(ref)06d.sel'),
+            'finalRef': os.path.join(path, 'mltomo_ref%(ref)06d.vol')
+        }
+        self._updateFilenamesDict(myDict)
+
+    def _getDirFileName(self, path, key, **kwargs):
+        """ File of the template key in the folder path (e.g. that of a shard) instead of extra, or
+        in extra if path is None. The templates are shared by the threads of the protocol, so
+        they are never changed to point to another folder. """
+        fn = self._getFileName(key, **kwargs)
+        return fn if path is None else os.path.join(path, os.path.basename(fn))
+
     # --------------------------- STEPS functions -------------------------------
+    @instrumented
     def convertInputStep(self):
+        # A restarted run iterates again from the beginning
+        self.convergedIteration.set(None)
+        self._store(self.convergedIteration)
         fnDir = self._getExtraPath("inputVolumes")
         makePath(fnDir)
-        fnRoot = os.path.join(fnDir, "subtomo")
-        writeSetOfVolumes(self.inputVolumes.get(), fnRoot)
-        self.fnSel = self._getExtraPath("subtomograms.sel")
-        self.runJob("xmipp_selfile_create", '"%s*.vol">%s' % (fnRoot, self.fnSel), numberOfMpi=1)
+        self._createFilesForMLTomo()
+        self._convertReferences()
+
+    def _convertReferences(self):
+        fnDir = self._getExtraPath("inputVolumes")
         if self.initialRef.get() is not None:
             fnRootRef = os.path.join(fnDir, "reference")
             if isinstance(self.initialRef.get(), Volume):
-                writeVolume(self.initialRef.get(),self._getExtraPath("reference.vol"))
+                self._writeVolume(self.initialRef.get(), self._getExtraPath("reference.vol"))
             else:
+                fnSelRef = self._getExtraPath("references.sel")
                 if isinstance(self.initialRef.get(), SetOfVolumes):
-                    writeSetOfVolumes(self.initialRef.get(), fnRootRef)
+                    writeSetOfVolumes(self.initialRef.get(), fnRootRef, numberOfProcs=self._getConversionProcs(),
+                                      fnSel=fnSelRef, downscale=self._getPreDownscDim())
                 elif isinstance(self.initialRef.get(), SetOfClassesSubTomograms):
-                    writeSetOfVolumes(self.initialRef.get().iterRepresentatives(), fnRootRef)
-                self.runJob("xmipp_selfile_create", '"%s*.vol">%s' % (fnRootRef, self._getExtraPath("references.sel")),
-                            numberOfMpi=1)
+                    writeSetOfVolumes(self.initialRef.get().iterRepresentatives(), fnRootRef,
+                                      numberOfProcs=self._getConversionProcs(), fnSel=fnSelRef,
+                                      downscale=self._getPreDownscDim())
         if self.inputMask.get() is not None:
-            self.fnMask = os.path.join(fnDir, "mask.vol")
-            writeVolume(self.inputMask.get(), self.fnMask)
+            self._writeVolume(self.inputMask.get(), self._getFileName('mask'))
 
-    def runMLTomo(self):
-        self._createFilesForMLTomo()
-        args = ' -i ' + self._getExtraPath("subtomograms.sel") + \
-               ' -o ' + self._getExtraPath("mltomo") + \
-               ' -doc ' + self._getExtraPath("subtomograms.doc") + \
-               ' -iter ' + str(self.numberOfIters.get()) + \
-               ' -ang ' + str(self.angularSampling.get()) + \
-               ' ' + self.extraParams.get()
-        if self.downscDim.get() is not None:
-            args = args + ' -dim ' + str(self.downscDim.get())
-        if self.initialRef.get() is not None:
-            if isinstance(self.initialRef.get(), Volume):
-                args = args + ' -ref ' + self._getExtraPath("reference.vol")
-            else:
-                args = args + ' -ref ' + self._getExtraPath("references.sel")
+    def _writeVolume(self, volume, outputFn):
+        if self._getPreDownscDim():
+            downscaleVolume(volume.getLocation(), outputFn, self._getPreDownscDim())
         else:
-            args = args + ' -nref ' + str(self.numberOfReferences.get())
-        if self.inputMask.get() is not None:
-            args = args + ' -mask ' + self.fnMask + ' -dont_align'
-        fhWedge = self._getExtraPath("wedge.doc")
-        if exists(fhWedge):
-            args = args + ' -missing ' + fhWedge
-        self.runJob("xmipp_ml_tomo", args, numberOfMpi=self.numberOfMpi.get())
+            writeVolume(volume, outputFn)
 
+    @instrumented
+    def runMLTomo(self, iStart=1, iEnd=None, stage=0):
+        """ Run the iterations from iStart to iEnd, those of the given stage of the schedule if
+        stage > 0. If some of them were already completed by a previous (interrupted) execution,
+        MLTomo is restarted from the last one. """
+        iEnd = iEnd or self.numberOfIters.get()
+        if self.convergedIteration.hasValue():
+            self.info("Converged at iteration %d, skipping iterations %d to %d"
+                      % (self.convergedIteration.get(), iStart, iEnd))
+            return
+        lastIter = self._getLastIteration()
+        if lastIter >= iEnd:
+            self.info("Iterations %d to %d were already completed" % (iStart, iEnd))
+            return
+        iStart = max(iStart, lastIter + 1)
+        variant = None
+        fnRef = None
+        if stage:
+            stageInfo = self._getStages()[stage - 1]
+            variant = {key: stageInfo[key] for key in ['angularSampling', 'downscDim']}
+            if iStart == stageInfo['first'] > 1:
+                fnRef = self._writeStageReferences(stage)
+        monitor = MLTomoMonitor(self)
+        monitor.start()
+        try:
+            if self.numberOfShards.get() > 1:
+                self._runShardedIterations(iStart, iEnd, fnRef=fnRef, variant=variant)
+            else:
+                self.runJob("xmipp_ml_tomo", self._getMLTomoArgs(iStart, iEnd, fnRef=fnRef, variant=variant),
+                            numberOfMpi=self.numberOfMpi.get())
+        finally:
+            monitor.stop()
+        if self.doEarlyStop.get() and self._hasConverged():
+            self.convergedIteration.set(self._getLastIteration())
+            self._store(self.convergedIteration)
+            self.info("Convergence reached at iteration %d" % self.convergedIteration.get())
+
+    @instrumented
     def createOutput(self):
         self.subtomoSet = self._createSetOfSubTomograms()
         inputSet = self.inputVolumes.get()
         self.subtomoSet.copyInfo(inputSet)
-        if self.numberOfIters < 10:
-            self.fnDoc = '%s/mltomo_it00000%d.doc' % (self._getExtraPath(), self.numberOfIters)
-        else:
-            self.fnDoc = '%s/mltomo_it0000%d.doc' % (self._getExtraPath(), self.numberOfIters)
-        self.docFile = open(self.fnDoc)
-        self.subtomoSet.copyItems(inputSet, updateItemCallback=self._updateItem)
-        self.docFile.close()
+        self._loadDocData(self._getFileName('iterDoc', iter=self._getLastIteration()))
+        # The items are inserted as they are read, in a single transaction committed when the
+        # set is written, so they do not need to be cloned
+        self.subtomoSet.copyItems(inputSet, updateItemCallback=self._updateItem, doClone=False)
+        self.missingItems.set(0)
+        self._addMissingItems(inputSet.getSize() - self.subtomoSet.getSize())
         classesSubtomoSet = self._createSetOfClassesSubTomograms(self.subtomoSet)
-        classesSubtomoSet.classifyItems(updateClassCallback=self._updateClass)
+        classesSubtomoSet.classifyItems(updateClassCallback=self._updateClass, doClone=False)
         self._defineOutputs(outputSubtomograms=self.subtomoSet)
         self._defineSourceRelation(self.inputVolumes, self.subtomoSet)
         self._defineOutputs(outputClassesSubtomo=classesSubtomoSet)
         self._defineSourceRelation(self.inputVolumes, classesSubtomoSet)
+        # The last iteration is not compacted, a continued run (see _getLastIteration)
+        # starts from its references
+        self._compactIterations()
         if self.cleanFiles.get():
             self._cleanFiles()
 
+    def sweepStep(self):
+        """ Run the variants of the sweep concurrently, as many at a time as fit in the MPI
+        processes of the protocol. Completed variants are not run again. """
+        variants = self._getSweepVariants()
+        numberOfIters = self.numberOfIters.get()
+        results = {result['variant']: result for result in self._loadSweepResults()}
+        fnInputs = {key: self._getFileName(key) for key in ['inputSel', 'inputDoc', 'wedgeDoc']}
+        jobs = []
+        for i, variant in enumerate(variants, 1):
+            if i in results:
+                continue
+            variantDir = self._getExtraPath(VARIANT_DIR % i)
+            makePath(variantDir)
+            for key, fnInput in fnInputs.items():
+                fnVariant = self._getDirFileName(variantDir, key)
+                if exists(fnInput) and not exists(fnVariant):
+                    createLink(fnInput, fnVariant)
+            iStart = self._getLastIteration(variantDir) + 1
+            jobs.append((i, variant, self._getMLTomoArgs(iStart, numberOfIters, variant=variant, path=variantDir),
+                         self._getDirFileName(variantDir, 'iterDoc', iter=numberOfIters)))
+        numberOfMpi = max(1, min(self.sweepMpi.get(), self.numberOfMpi.get()))
+        lock = threading.Lock()
+
+        def runVariant(job):
+            i, variant, args, fnDoc = job
+            self.info("Variant %d: %s" % (i, ', '.join('%s=%s' % item for item in variant.items())))
+            startTime = time.time()
+            self.runJob("xmipp_ml_tomo", args, numberOfMpi=numberOfMpi)
+            stats = iterationStats(readDocfileArray(fnDoc))
+            result = dict(variant, variant=i, meanLL=stats['meanLL'], occupancy=stats['occupancy'],
+                          runtime=time.time() - startTime)
+            with lock:
+                results[i] = result
+                self._writeSweepResults([results[key] for key in sorted(results)])
+
+        with ThreadPoolExecutor(max(1, self.numberOfMpi.get() // numberOfMpi)) as executor:
+            list(executor.map(runVariant, jobs))
+
+    def streamingStep(self):
+        """ Classify the input subtomograms in rounds while they arrive, until the input
+        is closed and all of them have been classified. """
+        if self.streamingRound.get() and not exists(self._getExtraPath(ROUND_DIR % self.streamingRound.get())):
+            # The rounds of a restarted run were removed, classify all the input again
+            self.streamingRound.set(0)
+            self.lastStreamedId.set(0)
+            self.missingItems.set(0)
+            self._store(self.streamingRound, self.lastStreamedId, self.missingItems)
+        makePath(self._getExtraPath("inputVolumes"))
+        self._convertReferences()
+        batchSize = max(1, self.streamingBatchSize.get())
+        while True:
+            inputSet = self._loadInputSet()
+            streamOpen = inputSet.isStreamOpen()
+            newItems = [item.clone() for item in inputSet.iterItems(where='id > %d' % self.lastStreamedId.get())]
+            inputSet.close()
+            if len(newItems) >= batchSize or (newItems and not streamOpen):
+                self._runStreamingRound(newItems[:batchSize])
+            elif streamOpen:
+                time.sleep(self.streamingSleepOnWait.get())
+            else:
+                break
+        self._closeStreamingOutputs()
+
     # --------------------------- INFO functions --------------------------------
+    def _validate(self):
+        errors = []
+        inputVols = self.inputVolumes.get()
+        if self.localRefinement.get() and inputVols is not None and inputVols.getSize():
+            # All the items of a set have the same attributes, the first one tells if they have transforms
+            if not inputVols.getFirstItem().hasTransform():
+                errors.append("Local refinement needs the alignment of the input, but the subtomograms do not "
+                              "have transforms")
+        if self.numberOfShards.get() > 1 and inputVols is not None and self.numberOfShards.get() > inputVols.getSize():
+            errors.append("There are more shards than subtomograms (%d)" % inputVols.getSize())
+        if self.doSweep.get():
+            errors.extend(self._getInvalidIntLists(['sweepReferences', 'sweepAngularSampling', 'sweepDownscDim']))
+            if inputVols is not None and self._getIntList(self.sweepDownscDim) is not None:
+                errors.extend(self._getInvalidDims('sweepDownscDim'))
+        if self.doSchedule.get():
+            invalid = self._getInvalidIntLists(['stageAngularSampling', 'stageDownscDim', 'stageIters'])
+            errors.extend(invalid)
+            if self.doSweep.get():
+                errors.append("The sweep runs every variant for all the iterations, it can not be combined "
+                              "with a coarse-to-fine schedule")
+            if inputVols is not None and self._getIntList(self.stageDownscDim) is not None:
+                errors.extend(self._getInvalidDims('stageDownscDim'))
+            if not (self.stageAngularSampling.get() or '').split():
+                errors.append("The schedule needs the angular sampling of at least one stage")
+            elif not invalid:
+                iters = self._getIntList(self.stageIters)
+                if iters and (len(iters) != len(self._getIntList(self.stageAngularSampling))
+                              or sum(iters) != self.numberOfIters.get()):
+                    errors.append("Give the iterations of every stage, adding up to the number of iterations")
+        return errors
+
     def _summary(self):
         summary = []
         if hasattr(self, 'outputClassesSubtomo'):
+            if self.doStreaming.get():
+                numberOfIters = self.streamingRound.get() * self.streamingIters.get()
+            else:
+                numberOfIters = self.convergedIteration.get() or self.numberOfIters.get()
             summary.append("Input subtomograms: *%d* \nRequested classes: *%d*\nGenerated classes: *%d* in *%d* "
                            "iterations\n" % (self.inputVolumes.get().getSize(), self.numberOfReferences,
-                                             self.outputClassesSubtomo.getSize(), self.numberOfIters))
+                                             self.outputClassesSubtomo.getSize(), numberOfIters))
+            if self.convergedIteration.hasValue():
+                summary.append("Stopped at convergence")
+            if self.missingItems.get():
+                summary.append("*%d* subtomograms missing or unassigned in the docfile are not in the outputs"
+                               % self.missingItems.get())
+            if self.doStreaming.get():
+                summary.append("Streaming: *%d* subtomograms classified in *%d* rounds of *%d* iterations"
+                               % (self.outputSubtomograms.getSize(), self.streamingRound.get(),
+                                  self.streamingIters.get()))
+        elif self.doSweep.get():
+            results = self._loadSweepResults()
+            summary.append("Sweep: *%d* of *%d* variants completed" % (len(results), len(self._getSweepVariants())))
+            for result in results:
+                summary.append("Variant %d: references %s, sampling %s, dim %s: mean LL %0.2f, class sizes %s, "
+                               "%0.1f s" % (result['variant'], result['numberOfReferences'],
+                                            result['angularSampling'], result['downscDim'] or '-', result['meanLL'],
+                                            ' '.join('%d' % count for count in result['occupancy'].values()),
+                                            result['runtime']))
         else:
             summary.append("Output classes not ready yet.")
+        if self.inputVolumes.get() is not None and self._getDownscDim():
+            summary.append("Downscaled dimension: *%d*%s%s"
+                           % (self._getDownscDim(),
+                              " (for %0.1f A)" % self.targetResolution.get() if self.downscDim.get() is None else "",
+                              ", downscaled before MLTomo" if self._getPreDownscDim() else ""))
+        metrics = self._loadMetrics()
+        if self.doSchedule.get() and not (self.doSweep.get() or self.doStreaming.get()):
+            summary.extend(self._getScheduleSummary(metrics))
+        if metrics:
+            last = metrics[-1]
+            summary.append("Iteration *%d*: mean LL %0.2f, Pmax/sumP median %0.3f [%0.3f, %0.3f], "
+                           "%s changed class, %0.1f s\nClass occupancy: %s"
+                           % (last['iteration'], last['meanLL'], last['pmax']['median'], last['pmax']['q1'],
+                              last['pmax']['q3'], "%0.1f%%" % (100 * last['changedClass'])
+                              if 'changedClass' in last else "-", last['wallTime'],
+                              ', '.join('%s: %d' % item for item in last['occupancy'].items())))
+        summary.extend(self._getStepsSummary())
         return summary
 
+    def _getScheduleSummary(self, metrics):
+        """ Lines describing the stages of the schedule with their timings. """
+        wallTimes = {stats['iteration']: stats['wallTime'] for stats in metrics}
+        stages = self._getStages()
+        if not stages:
+            return []
+        lines = []
+        for stage, stageInfo in enumerate(stages, 1):
+            iterations = range(stageInfo['first'], stageInfo['last'] + 1)
+            done = [it for it in iterations if it in wallTimes]
+            lines.append("Stage %d: iterations %d-%d, sampling %d deg, dim %s: %s"
+                         % (stage, stageInfo['first'], stageInfo['last'], stageInfo['angularSampling'],
+                            stageInfo['downscDim'] or 'full',
+                            "%0.1f s" % sum(wallTimes[it] for it in done) if done else "not run yet"))
+        # The orientations evaluated per iteration grow as the cube of 1/sampling
+        finest = min(stageInfo['angularSampling'] for stageInfo in stages)
+        evaluations = sum((stageInfo['last'] - stageInfo['first'] + 1)
+                          * (finest / float(stageInfo['angularSampling'])) ** 3 for stageInfo in stages)
+        lines.append("Orientation evaluations: %0.1f%% of running all the iterations at %d deg"
+                     % (100 * evaluations / max(1, stages[-1]['last']), finest))
+        return lines
+
     def _methods(self):
         methods = []
         if hasattr(self, 'outputClassesSubtomo'):
@@ -182,79 +585,764 @@ class Xmipp2ProtMLTomo(ProtTomoSubtomogramAveraging):
         return ['Scheres2009c']
 
     # --------------------------- UTILS functions ----------------------------------
-    def _createFilesForMLTomo(self):
+    @instrumented
+    def _createFilesForMLTomo(self, items=None, path=None):
+        """ Write the wedge file and convert the input volumes, writing their sel and doc files
+        in the same pass, to path (extra by default). In streaming, only the given items (those
+        of the round) are used. """
         inputVols = self.inputVolumes.get()
         mw = 0
-        if isinstance(inputVols, SetOfVolumes):
-            mw = 1
-            fhWedge = open(self._getExtraPath("wedge.doc"), 'w')
+        if isinstance(inputVols, SetOfSubTomograms) and inputVols.getFirstItem().getAcquisition().getAngleMin():
+            if items is None:
+                # Distinct wedges and their sizes straight from the set database
+                wedges = [((row[ANGLE_MIN], row[ANGLE_MAX]), row['COUNT'])
+                          for row in inputVols.aggregate(['COUNT'], ANGLE_MIN, [ANGLE_MIN, ANGLE_MAX])]
+            else:
+                wedges = Counter((item.getAcquisition().getAngleMin(), item.getAcquisition().getAngleMax())
+                                 for item in items).items()
+            wedgeDict = {}
+            fhWedge = open(self._getDirFileName(path, 'wedgeDoc'), 'w')
             fhWedge.write(" ; Wedgeinfo\n ; wedge_y\n")
-            fhWedge.write("1 2 -90 90\n")
+            for i, (key, count) in enumerate(sorted(wedges), 1):
+                wedgeDict[key] = i
+                fhWedge.write("%d 2 %d %d\n" % (i, key[0], key[1]))
+                self.info("Wedge %d: tilt range [%s, %s], %d subtomograms" % (i, key[0], key[1], count))
             fhWedge.close()
-        elif inputVols.getFirstItem().getAcquisition().getAngleMin():
+
+            def mw(subtomogram):
+                acquisition = subtomogram.getAcquisition()
+                return wedgeDict[(acquisition.getAngleMin(), acquisition.getAngleMax())]
+
+        elif isinstance(inputVols, SetOfVolumes):
             mw = 1
-            wedgeDict={}
-            for subtomogram in inputVols:
-                key = (subtomogram.getAcquisition().getAngleMin(), subtomogram.getAcquisition().getAngleMax())
-                if not key in wedgeDict:
-                    wedgeDict[key] = []
-                wedgeDict[key].append(subtomogram)
-            fhWedge = open(self._getExtraPath("wedge.doc"), 'w')
+            fhWedge = open(self._getDirFileName(path, 'wedgeDoc'), 'w')
             fhWedge.write(" ; Wedgeinfo\n ; wedge_y\n")
-            i=1
-            for key in wedgeDict:
-                fhWedge.write("%d 2 %d %d\n" %(i,key[0],key[1]))
-                i+=1
+            fhWedge.write("1 2 -90 90\n")
             fhWedge.close()
 
-        fhDoc = open(self._getExtraPath("subtomograms.doc"), 'w')
-        fhSel = open(self._getExtraPath("subtomograms.sel"), 'r')
-
-        if inputVols.getFirstItem().getTransform() is None:
-            j = 1
-            fhDoc.write(" ; Headerinfo columns: rot (1), tilt (2), psi (3), Xoff (4), Yoff (5), Zoff (6), Ref (7), "
-                        "Wedge (8), Pmax/sumP (9), LL (10)\n")
-            for line in fhSel:
-                imgName = line.split()[0]
-                fhDoc.write(" ; %s\n%d 10  0 0 0 0 0 0 0 %d 0 0\n" % (imgName, j, mw))
-                j += 1
+        cache = None
+        if self.useVolumeCache.get():
+            cache = VolumeCache(self.getProject().getTmpPath(VOLUME_CACHE), self.volumeCacheSize.get() * 1024 ** 3)
+        writeSetOfVolumes(inputVols if items is None else items,
+                          os.path.join(self._getExtraPath("inputVolumes"), "subtomo"),
+                          numberOfProcs=self._getConversionProcs(), cache=cache,
+                          fnSel=self._getDirFileName(path, 'inputSel'), fnDoc=self._getDirFileName(path, 'inputDoc'),
+                          wedge=mw, downscale=self._getPreDownscDim())
+
+    def _getMLTomoArgs(self, iStart, iEnd, fnRef=None, fnDoc=None, variant=None, path=None):
+        """ Arguments to run xmipp_ml_tomo from iteration iStart to iEnd, with the input and
+        output files in path (extra by default). After the first iteration, the run is seeded
+        with the docfile and references of the previous one. fnRef and fnDoc override the
+        references and docfile to start from (e.g. the previous round in streaming or the
+        docfile of a shard), and variant the numberOfReferences, angularSampling and downscDim
+        of the form (a variant of a sweep). """
+        variant = variant or {}
+        downscDim = variant.get('downscDim', self._getDownscDim())
+        if downscDim is not None and downscDim == self._getPreDownscDim():
+            # The input is already at that size
+            downscDim = None
+        args = ' -i ' + self._getDirFileName(path, 'inputSel') + \
+               ' -o ' + self._getDirFileName(path, 'outputRoot') + \
+               ' -iter ' + str(iEnd) + \
+               ' -ang ' + str(variant.get('angularSampling', self.angularSampling.get())) + \
+               ' ' + self.extraParams.get()
+        if downscDim is not None:
+            args = args + ' -dim ' + str(downscDim)
+        if iStart > 1:
+            args = args + ' -istart ' + str(iStart) + \
+                   ' -doc ' + (fnDoc or self._getDirFileName(path, 'iterDoc', iter=iStart - 1)) + \
+                   ' -ref ' + (fnRef or self._getDirFileName(path, 'iterSel', iter=iStart - 1))
+        else:
+            args = args + ' -doc ' + (fnDoc or self._getDirFileName(path, 'inputDoc'))
+            if fnRef is not None:
+                args = args + ' -ref ' + fnRef
+            elif self.initialRef.get() is not None:
+                if isinstance(self.initialRef.get(), Volume):
+                    args = args + ' -ref ' + self._getExtraPath("reference.vol")
+                else:
+                    args = args + ' -ref ' + self._getExtraPath("references.sel")
+            else:
+                args = args + ' -nref ' + str(variant.get('numberOfReferences', self.numberOfReferences.get()))
+        if self.localRefinement.get():
+            args = args + ' -ang_search ' + str(self.localAngularRange.get()) + \
+                   ' -limit_trans ' + str(self.localShiftRange.get())
+        if self.inputMask.get() is not None:
+            args = args + ' -mask ' + self._getFileName('mask') + ' -dont_align'
+        fhWedge = self._getDirFileName(path, 'wedgeDoc')
+        if exists(fhWedge):
+            args = args + ' -missing ' + fhWedge
+        return args
+
+    def _iterIterationFiles(self):
+        """ Iterate over the files of the iterations that exist in extra, yielding their
+        iteration, kind ('ref', 'wedge' or None), reference, extension and path. """
+        fnDir = self._getExtraPath()
+        for fn in sorted(os.listdir(fnDir)):
+            match = ITER_FILE_REGEX.match(fn)
+            if match:
+                it, kind, ref, ext = match.groups()
+                yield int(it), kind, int(ref) if ref else None, ext, os.path.join(fnDir, fn)
+
+    def _pruneIterations(self):
+        """ Apply the retention policy while MLTomo runs: remove the files of the iterations
+        but the last keepLastIters ones and the multiples of keepEveryIter, which are archived
+        if requested. Only the iterations whose metrics are already recorded are pruned. """
+        keepLast = self.keepLastIters.get()
+        metrics = self._loadMetrics()
+        if not keepLast or not metrics:
+            return
+        lastPruned = metrics[-1]['iteration'] - keepLast
+        keepEvery = self.keepEveryIter.get()
+        iterationFiles = {}
+        for it, _, _, _, fn in self._iterIterationFiles():
+            if it <= lastPruned:
+                iterationFiles.setdefault(it, []).append(fn)
+        for it, files in iterationFiles.items():
+            if keepEvery and it % keepEvery == 0:
+                if not self.archiveKeptIters.get():
+                    continue
+                self._archiveIteration(it, files)
+            for fn in files:
+                os.remove(fn)
+
+    def _compactIterations(self):
+        """ Move the references and wedges of the iterations whose metrics are recorded to the
+        volume history. The last of them is kept as Spider files, to continue the run from it. """
+        metrics = self._loadMetrics()
+        if not self.compactIterations.get() or not metrics:
+            return
+        lastCompacted = metrics[-1]['iteration'] - 1
+        iterationVolumes = {}
+        for it, kind, ref, ext, fn in self._iterIterationFiles():
+            if ext == 'vol' and it <= lastCompacted:
+                iterationVolumes.setdefault(it, {'ref': {}, 'wedge': {}})[kind][ref] = fn
+        history = self._getVolumeHistory()
+        for it, volumes in sorted(iterationVolumes.items()):
+            history.add(it, volumes['ref'], volumes['wedge'])
+            for fn in itertools.chain(volumes['ref'].values(), volumes['wedge'].values()):
+                os.remove(fn)
+
+    def _getVolumeHistory(self):
+        return VolumeHistory(self._getExtraPath(HISTORY_DIR))
+
+    def _archiveIteration(self, it, files):
+        """ Pack the files of an iteration in extra/archive/mltomo_itNNNNNN.tar.gz. """
+        fnDir = self._getExtraPath(ARCHIVE_DIR)
+        makePath(fnDir)
+        fnArchive = os.path.join(fnDir, 'mltomo_it%06d.tar.gz' % it)
+        with tarfile.open(fnArchive + '.tmp', 'w:gz') as tar:
+            for fn in files:
+                if not fn.endswith('.npy'):
+                    tar.add(fn, arcname=os.path.basename(fn))
+        os.replace(fnArchive + '.tmp', fnArchive)
+
+    def _getLastIteration(self, path=None):
+        """ Return the last iteration in path (extra by default) whose docfile and references
+        are complete, 0 if none. """
+        fnDir = os.path.dirname(self._getDirFileName(path, 'outputRoot'))
+        iterations = sorted((int(m.group(1)) for m in map(ITER_DOC_REGEX.match, os.listdir(fnDir)) if m),
+                            reverse=True)
+        numberOfParticles = self._countEntries(self._getDirFileName(path, 'inputSel'))
+        for it in iterations:
+            fnSel = self._getDirFileName(path, 'iterSel', iter=it)
+            if (exists(fnSel) and all(exists(fnRef) for fnRef in readSelFile(fnSel))
+                    and self._countEntries(self._getDirFileName(path, 'iterDoc', iter=it)) == numberOfParticles):
+                return it
+        return 0
+
+    @staticmethod
+    def _countEntries(fn):
+        """ Number of entries (non comment lines) of a sel or doc file. """
+        with open(fn) as fh:
+            return sum(1 for line in fh if line.strip() and not line.lstrip().startswith(';'))
+
+    def _runShardedIterations(self, iStart, iEnd, fnRef=None, variant=None):
+        """ Run the iterations from iStart to iEnd in shards, the first one starting from
+        fnRef if given (see _getMLTomoArgs). """
+        for it in range(iStart, iEnd + 1):
+            if it == 1 and self.initialRef.get() is None:
+                # All the shards have to start from the same random references
+                self.runJob("xmipp_ml_tomo", self._getMLTomoArgs(1, 1, variant=variant),
+                            numberOfMpi=self.numberOfMpi.get())
+            else:
+                self._runShardedIteration(it, fnRef=fnRef if it == iStart else None, variant=variant)
+
+    def _runShardedIteration(self, it, fnRef=None, variant=None):
+        """ Run iteration it as an independent MLTomo job per shard of the particles, and merge
+        their docfiles, references and FSC into the files of the iteration. A reference that no
+        shard wrote is kept from the previous iteration. """
+        numberOfShards = self.numberOfShards.get()
+        fnSel = self._getFileName('inputSel')
+        fnDoc = self._getFileName('iterDoc', iter=it - 1) if it > 1 else self._getFileName('inputDoc')
+        if fnRef is None and it > 1:
+            fnRef = self._getFileName('iterSel', iter=it - 1)
+        fnWedge = self._getFileName('wedgeDoc')
+        shardDirs = [self._getExtraPath('shards', 'shard%03d' % shard) for shard in range(1, numberOfShards + 1)]
+        shardInputs = []
+        shardArgs = []
+        for shardDir in shardDirs:
+            cleanPath(shardDir)
+            makePath(shardDir)
+            shardInputs.append((self._getDirFileName(shardDir, 'inputSel'),
+                                self._getDirFileName(shardDir, 'inputDoc')))
+            if exists(fnWedge):
+                createLink(fnWedge, self._getDirFileName(shardDir, 'wedgeDoc'))
+            shardArgs.append(self._getMLTomoArgs(it, it, fnRef=fnRef, fnDoc=shardInputs[-1][1], variant=variant,
+                                                 path=shardDir))
+        splitDocfile(fnSel, fnDoc, shardInputs)
+
+        hosts = self._getShardHosts()
+        numberOfMpi = max(1, self.numberOfMpi.get() // numberOfShards)
+
+        def runShard(shard):
+            if hosts:
+                self.runJob("ssh", "%s 'cd %s && xmipp_ml_tomo %s'"
+                            % (hosts[shard % len(hosts)], os.getcwd(), shardArgs[shard]))
+            else:
+                self.runJob("xmipp_ml_tomo", shardArgs[shard], numberOfMpi=numberOfMpi)
+
+        with ThreadPoolExecutor(numberOfShards) as executor:
+            list(executor.map(runShard, range(numberOfShards)))
+
+        def shardFiles(key, **kwargs):
+            return [self._getDirFileName(shardDir, key, **kwargs) for shardDir in shardDirs]
+
+        shardDocs = shardFiles('iterDoc', iter=it)
+        mergeDocfiles(shardDocs, fnSel, self._getFileName('iterDoc', iter=it))
+        numberOfRefs = len(readSelFile(shardFiles('iterSel', iter=it)[0]))
+        # Each shard contributes to a reference in proportion to its particles in that class
+        weights = np.array([np.bincount(readDocfileArray(fnShardDoc)['ref'].astype(int),
+                                        minlength=numberOfRefs + 1)[1:numberOfRefs + 1]
+                            for fnShardDoc in shardDocs])
+        fnPreviousRefs = readSelFile(fnRef) if fnRef else []
+        fnRefs = []
+        for ref in range(1, numberOfRefs + 1):
+            for key in ['iterRef', 'iterWedge']:
+                fnShardVols = shardFiles(key, iter=it, ref=ref)
+                written = [shard for shard, fnVol in enumerate(fnShardVols) if exists(fnVol)]
+                if written:
+                    mergeVolumes([fnShardVols[shard] for shard in written], weights[written, ref - 1],
+                                 self._getFileName(key, iter=it, ref=ref))
+                elif key == 'iterRef':
+                    # No shard wrote the reference, it is kept from the previous iteration
+                    if ref > len(fnPreviousRefs):
+                        raise Exception("No shard wrote the reference %d of iteration %d" % (ref, it))
+                    self.warning("No shard wrote the reference %d of iteration %d, keeping the previous one"
+                                 % (ref, it))
+                    shutil.copyfile(fnPreviousRefs[ref - 1], self._getFileName(key, iter=it, ref=ref))
+            with open(self._getFileName('iterRefSel', iter=it, ref=ref), 'w') as fhRefSel:
+                for fnShardSel in shardFiles('iterRefSel', iter=it, ref=ref):
+                    if exists(fnShardSel):
+                        with open(fnShardSel) as fhShardSel:
+                            fhRefSel.write(fhShardSel.read())
+            fnRefs.append(self._getFileName('iterRef', iter=it, ref=ref))
+            shutil.copyfile(fnRefs[-1], self._getFileName('finalRef', ref=ref))
+        fnShardFscs = shardFiles('iterFsc', iter=it)
+        written = [shard for shard, fnFsc in enumerate(fnShardFscs) if exists(fnFsc)]
+        if written:
+            mergeFscFiles([fnShardFscs[shard] for shard in written], weights[written],
+                          self._getFileName('iterFsc', iter=it))
+        # The sel file is written the last, it marks the iteration as completed
+        with open(self._getFileName('iterSel', iter=it), 'w') as fhSel:
+            fhSel.writelines("%s 1\n" % fnRef for fnRef in fnRefs)
+
+    def _getStages(self):
+        """ Stages of the coarse-to-fine schedule, a list of dicts with their first and last
+        iterations, angularSampling and downscDim. Empty if the lists of the form are not
+        valid (see _validate). """
+        samplings = self._getIntList(self.stageAngularSampling)
+        dims = self._getIntList(self.stageDownscDim)
+        iters = self._getIntList(self.stageIters)
+        if not samplings or dims is None or iters is None:
+            return []
+        if not iters:
+            iters = [len(chunk) for chunk in np.array_split(range(self.numberOfIters.get()), len(samplings))]
+        stages = []
+        first = 1
+        for i, (angularSampling, numberOfIters) in enumerate(zip(samplings, iters)):
+            stages.append({'first': first, 'last': first + numberOfIters - 1, 'angularSampling': angularSampling,
+                           'downscDim': dims[i] if i < len(dims) else self._getDownscDim()})
+            first += numberOfIters
+        return stages
+
+    @staticmethod
+    def _getIntList(param):
+        """ Values of a param with space separated integers, None if some of them is not an integer. """
+        try:
+            return [int(value) for value in (param.get() or '').split()]
+        except ValueError:
+            return None
+
+    def _getInvalidIntLists(self, paramNames):
+        """ Errors for the params whose values are not space separated integers. """
+        return ["%s: give integers separated by spaces" % self.getParam(paramName).label.get()
+                for paramName in paramNames if self._getIntList(getattr(self, paramName)) is None]
+
+    def _getInvalidDims(self, paramName):
+        """ Error for a param with space separated dimensions if some of them is odd or larger
+        than the volumes MLTomo reads (those of the input, or pre-downscaled). """
+        maxDim = self._getPreDownscDim() or self.inputVolumes.get().getDim()[0]
+        if any(dim % 2 or dim > maxDim for dim in self._getIntList(getattr(self, paramName))):
+            return ["%s: give even dimensions not larger than %d" % (self.getParam(paramName).label.get(), maxDim)]
+        return []
+
+    def _writeStageReferences(self, stage):
+        """ Resize the references of the last iteration of the previous stage to the dimension
+        of the input of MLTomo, which downscales them to that of this stage with -dim, return
+        the sel file listing them. """
+        stageInfo = self._getStages()[stage - 1]
+        dim = self._getPreDownscDim() or self.inputVolumes.get().getDim()[0]
+        stageDir = self._getExtraPath(STAGE_DIR % stage)
+        makePath(stageDir)
+        fnRefs = []
+        for ref, fnRef in enumerate(readSelFile(self._getFileName('iterSel', iter=stageInfo['first'] - 1)), 1):
+            fnRefs.append(os.path.join(stageDir, 'ref%06d.vol' % ref))
+            resizeVolume(fnRef, fnRefs[-1], dim)
+        fnSel = os.path.join(stageDir, 'references.sel')
+        with open(fnSel, 'w') as fhSel:
+            fhSel.writelines("%s 1\n" % fnRef for fnRef in fnRefs)
+        return fnSel
+
+    def _getSweepVariants(self):
+        """ Combinations of the values of the sweep, a list of dicts with numberOfReferences,
+        angularSampling and downscDim. Empty if the lists of the form are not valid (see _validate). """
+        values = []
+        for key, param in [('numberOfReferences', self.sweepReferences),
+                           ('angularSampling', self.sweepAngularSampling),
+                           ('downscDim', self.sweepDownscDim)]:
+            default = self._getDownscDim() if key == 'downscDim' else getattr(self, key).get()
+            paramValues = self._getIntList(param)
+            if paramValues is None:
+                return []
+            values.append([(key, value) for value in paramValues] or [(key, default)])
+        return [dict(variant) for variant in itertools.product(*values)]
+
+    def _loadSweepResults(self):
+        fnSweep = self._getExtraPath(SWEEP_FILE)
+        if not exists(fnSweep):
+            return []
+        with open(fnSweep) as fhSweep:
+            return json.load(fhSweep)
+
+    def _writeSweepResults(self, results):
+        fnSweep = self._getExtraPath(SWEEP_FILE)
+        with open(fnSweep + '.tmp', 'w') as fhSweep:
+            json.dump(results, fhSweep, indent=1)
+        os.replace(fnSweep + '.tmp', fnSweep)
+
+    def _getShardHosts(self):
+        """ Hosts of the host file, the first word of each of its lines. """
+        if not self.shardHostFile.get():
+            return []
+        with open(self.shardHostFile.get()) as fhHosts:
+            return [line.split()[0] for line in fhHosts if line.strip() and not line.lstrip().startswith('#')]
+
+    def _loadStepStats(self):
+        """ Resources used by each execution of the steps, recorded by StepProfiler. """
+        fnSteps = self._getExtraPath(STEPS_FILE)
+        if not exists(fnSteps):
+            return []
+        with open(fnSteps) as fhSteps:
+            return json.load(fhSteps)
+
+    def _addStepStats(self, stats):
+        stepStats = self._loadStepStats()
+        stepStats.append(stats)
+        fnSteps = self._getExtraPath(STEPS_FILE)
+        with open(fnSteps + '.tmp', 'w') as fhSteps:
+            json.dump(stepStats, fhSteps, indent=1)
+        os.replace(fnSteps + '.tmp', fnSteps)
+
+    def _getStepsSummary(self):
+        """ One line per step with the resources of all its executions, and the peak RSS of
+        the protocol process and of its largest child. """
+        stepStats = self._loadStepStats()
+        totals = {}
+        for stats in stepStats:
+            total = totals.setdefault(stats['step'], Counter())
+            total.update({key: stats[key] or 0 for key in ['wallTime', 'cpuTime', 'bytesRead', 'bytesWritten',
+                                                           'newFiles']})
+            total['runs'] += 1
+        lines = []
+        for step, total in totals.items():
+            lines.append("%s: %0.1f s (CPU %0.1f s) in %d run(s), read %s, written %s, %+d files"
+                         % (step, total['wallTime'], total['cpuTime'], total['runs'],
+                            prettySize(total['bytesRead']), prettySize(total['bytesWritten']), total['newFiles']))
+        if stepStats:
+            lines.append("Process peak RSS: %s, largest child process: %s"
+                         % (prettySize(max(stats['processPeakRss'] for stats in stepStats)),
+                            prettySize(max(stats['childrenPeakRss'] for stats in stepStats))))
+        return lines
+
+    def _loadMetrics(self):
+        """ Per iteration metrics recorded by MLTomoMonitor. """
+        fnMetrics = self._getExtraPath(METRICS_FILE)
+        if not exists(fnMetrics):
+            return []
+        with open(fnMetrics) as fhMetrics:
+            return json.load(fhMetrics)
+
+    def _updateMetrics(self, startTime):
+        """ Add to the metrics file the statistics of the iterations completed since the last
+        update, those whose docfile lists all the subtomograms. The docfiles are scanned
+        directly, so the metrics of a cleaned run can be rebuilt from the docfile it keeps.
+        Iterations finished before startTime are timed from startTime. """
+        metrics = self._loadMetrics()
+        lastRecorded = metrics[-1]['iteration'] if metrics else 0
+        fnDir = os.path.dirname(self._getFileName('outputRoot'))
+        docIterations = (int(m.group(1)) for m in map(ITER_DOC_REGEX.match, os.listdir(fnDir)) if m)
+        iterations = sorted(it for it in docIterations if it > lastRecorded)
+        if not iterations:
+            return
+        numberOfParticles = self._countEntries(self._getFileName('inputSel'))
+        fnPrevious = self._getFileName('iterDoc', iter=lastRecorded)
+        previous = readDocfileArray(fnPrevious) if exists(fnPrevious) else None
+        previousTime = os.path.getmtime(fnPrevious) if exists(fnPrevious) else startTime
+        previousIter = lastRecorded
+        for it in iterations:
+            fnDoc = self._getFileName('iterDoc', iter=it)
+            if self._countEntries(fnDoc) != numberOfParticles:
+                # Still being written by MLTomo
+                break
+            data = readDocfileArray(fnDoc)
+            # The changes are only computed between consecutive iterations (cleaned runs keep the last one)
+            stats = iterationStats(data, previous if previousIter == it - 1 else None,
+                                   self._getIterationAngularSampling(it))
+            docTime = os.path.getmtime(fnDoc)
+            stats.update(iteration=it, wallTime=docTime - max(previousTime, startTime))
+            metrics.append(stats)
+            previous = data
+            previousTime = docTime
+            previousIter = it
+        if previousIter == lastRecorded:
+            return
+        # The protocol monitor and a viewer may update the metrics at the same time
+        fnMetrics = self._getExtraPath(METRICS_FILE)
+        fnTmp = '%s.%d.%d.tmp' % (fnMetrics, os.getpid(), threading.get_ident())
+        with open(fnTmp, 'w') as fhMetrics:
+            json.dump(metrics, fhMetrics)
+        os.replace(fnTmp, fnMetrics)
+
+    def _hasConverged(self):
+        """ Check the convergence criteria on the metrics of the last iteration. """
+        metrics = self._loadMetrics()
+        if not metrics or 'changedClass' not in metrics[-1]:
+            return False
+        last = metrics[-1]
+        criteria = [(self.convClassChange.get(), last['changedClass']),
+                    (self.convAngleChange.get(), last['medianAngleChange'])]
+        if len(metrics) > 1 and metrics[-2]['meanLL']:
+            criteria.append((self.convLLChange.get(),
+                             abs((last['meanLL'] - metrics[-2]['meanLL']) / metrics[-2]['meanLL'])))
+        criteria = [(threshold, value) for threshold, value in criteria if threshold >= 0]
+        return bool(criteria) and all(value <= threshold for threshold, value in criteria)
+
+    def _getDownscDim(self):
+        """ Downscaled dimension of the form or, if empty, the one suggested for the target
+        resolution. None if the volumes are not downscaled. """
+        if self.downscDim.get() is None and self.targetResolution.get():
+            inputVols = self.inputVolumes.get()
+            return getDownscaledDim(inputVols.getDim()[0], inputVols.getSamplingRate(), self.targetResolution.get())
+        return self.downscDim.get()
+
+    def _getPreDownscDim(self):
+        """ Dimension to which the volumes are downscaled while converting them, if any. """
+        downscDim = self._getDownscDim()
+        if self.preDownscale.get() and downscDim and downscDim < self.inputVolumes.get().getDim()[0]:
+            return downscDim
+        return None
+
+    def _getDownscaleFactor(self, downscDim):
+        """ Ratio between the size of the input volumes and downscDim, 1 if None. """
+        inputDim = self.inputVolumes.get().getDim()[0]
+        return inputDim / float(downscDim) if downscDim and downscDim < inputDim else 1.
+
+    def _getIterationAngularSampling(self, it):
+        """ Angular sampling (in degrees) of iteration it. """
+        if self.doSchedule.get():
+            for stageInfo in self._getStages():
+                if stageInfo['first'] <= it <= stageInfo['last']:
+                    return stageInfo['angularSampling']
+        return self.angularSampling.get()
+
+    def _getIterationSamplingRate(self, it):
+        """ Sampling rate of the volumes MLTomo works with in iteration it. """
+        downscDim = self._getDownscDim()
+        if self.doSchedule.get():
+            inputDim = self.inputVolumes.get().getDim()[0]
+            downscDim = next((stageInfo['downscDim'] or inputDim for stageInfo in self._getStages()
+                              if stageInfo['first'] <= it <= stageInfo['last']), downscDim)
+        return self.inputVolumes.get().getSamplingRate() * self._getDownscaleFactor(downscDim)
+
+    def _loadFscHistory(self):
+        """ FSC of the iterations whose metrics are recorded (of all of them if there are no
+        metrics), see loadFscHistory. They are cached in extra, so each FSC file is parsed once
+        and the FSC are kept after the iteration files are removed. """
+        metrics = self._loadMetrics()
+        lastIter = metrics[-1]['iteration'] if metrics else None
+        fnFscs = {it: fn for it, _, _, ext, fn in self._iterIterationFiles()
+                  if ext == 'fsc' and (lastIter is None or it <= lastIter)}
+        return loadFscHistory(fnFscs, self._getExtraPath(FSC_CACHE))
+
+    def _loadDocData(self, fnDoc):
+        """ Load the docfile of an iteration for readDocfile, with the shifts in pixels of the input. """
+        self.fnDoc = fnDoc
+        self.docData = readDocfileArray(fnDoc)
+        self.docIndex = {objId: i for i, objId in enumerate(self.docData['id'].tolist())}
+        if self._getPreDownscDim():
+            factor = self._getDownscaleFactor(self._getPreDownscDim())
+            for label in ['xoff', 'yoff', 'zoff']:
+                self.docData[label] *= factor
+        self.docMatrices = docfileMatrices(self.docData)
+        self.classStats = classStatistics(self.docData)
+
+    def _getConversionProcs(self):
+        """ Number of processes used to convert the input, the cores reserved for the protocol. """
+        return max(1, self.numberOfThreads.get() or 1, self.numberOfMpi.get() or 1)
+
+    def _loadInputSet(self):
+        """ Load the input set again from its database to see the items added in streaming. """
+        inputSet = self.inputVolumes.get()
+        newSet = type(inputSet)(filename=inputSet.getFileName())
+        newSet.loadAllProperties()
+        return newSet
+
+    def _runStreamingRound(self, items):
+        """ Classify a batch of new subtomograms with a few MLTomo iterations, seeded with the
+        references of the previous round, and add them to the outputs. """
+        roundNumber = self.streamingRound.get() + 1
+        fnRef = None
+        if roundNumber > 1:
+            previousDir = self._getExtraPath(ROUND_DIR % (roundNumber - 1))
+            fnRef = self._getDirFileName(previousDir, 'iterSel', iter=self._getLastIteration(previousDir))
+        roundDir = self._getExtraPath(ROUND_DIR % roundNumber)
+        makePath(roundDir)
+        self.info("Round %d: classifying %d subtomograms (ids %d to %d)"
+                  % (roundNumber, len(items), items[0].getObjId(), items[-1].getObjId()))
+        self._createFilesForMLTomo(items, path=roundDir)
+        self.runJob("xmipp_ml_tomo", self._getMLTomoArgs(1, self.streamingIters.get(), fnRef=fnRef, path=roundDir),
+                    numberOfMpi=self.numberOfMpi.get())
+        self._updateStreamingOutputs(items, roundDir)
+        self.streamingRound.set(roundNumber)
+        self.lastStreamedId.set(items[-1].getObjId())
+        self._store(self.streamingRound, self.lastStreamedId)
+
+    def _updateStreamingOutputs(self, items, roundDir):
+        """ Append the items of the round in roundDir to the output subtomograms and classes,
+        and update the class representatives with the references of the round. """
+        lastIter = self._getLastIteration(roundDir)
+        self._loadDocData(self._getDirFileName(roundDir, 'iterDoc', iter=lastIter))
+        # The representatives are the references of the last round, copied to the extra folder
+        numberOfRefs = len(readSelFile(self._getDirFileName(roundDir, 'iterSel', iter=lastIter)))
+        for ref in range(1, numberOfRefs + 1):
+            shutil.copyfile(self._getDirFileName(roundDir, 'finalRef', ref=ref), self._getFileName('finalRef', ref=ref))
+        firstRound = not hasattr(self, 'outputSubtomograms')
+        self.subtomoSet, classesSubtomoSet = self._getStreamingOutputs()
+        appended = 0
+        for item in items:
+            # Items without alignment are not classified
+            if readDocfile(self, item):
+                self.subtomoSet.append(item)
+                appended += 1
+        self._addMissingItems(len(items) - appended)
+        self.subtomoSet.write()
+        classesSubtomoSet.classifyItems(updateClassCallback=self._updateClass,
+                                        iterParams={'where': 'id > %d' % self.lastStreamedId.get()})
+        classesSubtomoSet.write()
+        if firstRound:
+            self._defineOutputs(outputSubtomograms=self.subtomoSet)
+            self._defineSourceRelation(self.inputVolumes, self.subtomoSet)
+            self._defineOutputs(outputClassesSubtomo=classesSubtomoSet)
+            self._defineSourceRelation(self.inputVolumes, classesSubtomoSet)
         else:
-            writeDocfile(self, fhSel, fhDoc, inputVols, mw)
+            self._store(self.subtomoSet, classesSubtomoSet)
+
+    def _getStreamingOutputs(self):
+        """ Output sets open for appending: created in the first round, loaded from the
+        protocol outputs when a stopped run is continued. """
+        if not hasattr(self, '_streamingOutputs'):
+            if hasattr(self, 'outputSubtomograms'):
+                outputs = (self.outputSubtomograms, self.outputClassesSubtomo)
+                for outputSet in outputs:
+                    outputSet.enableAppend()
+            else:
+                subtomoSet = self._createSetOfSubTomograms()
+                subtomoSet.copyInfo(self.inputVolumes.get())
+                outputs = (subtomoSet, self._createSetOfClassesSubTomograms(subtomoSet))
+                for outputSet in outputs:
+                    outputSet.setStreamState(Set.STREAM_OPEN)
+            self._streamingOutputs = outputs
+        return self._streamingOutputs
 
-        fhDoc.close()
-        fhSel.close()
+    def _closeStreamingOutputs(self):
+        if hasattr(self, 'outputSubtomograms'):
+            for outputSet in self._getStreamingOutputs():
+                outputSet.setStreamState(Set.STREAM_CLOSED)
+                outputSet.write()
+                self._store(outputSet)
+
+    def _addMissingItems(self, missingItems):
+        """ Count the input subtomograms left out of the outputs because they are not in the
+        loaded docfile or not assigned to a class (see readDocfile). """
+        if missingItems:
+            self.warning("%d subtomograms are missing or unassigned in %s and are not in the outputs"
+                         % (missingItems, self.fnDoc))
+        self.missingItems.set(self.missingItems.get() + missingItems)
+        self._store(self.missingItems)
 
     def _updateItem(self, item, row):
-        readDocfile(self, item)
+        # Items are not cloned, the flag must be set for every one of them
+        item._appendItem = readDocfile(self, item)
 
     def _updateClass(self, item):
+        """ Set the representative of a class, the final reference of MLTomo, and its size,
+        mean Pmax/sumP and mean LL from the class index of the docfile (see _loadDocData).
+        In streaming, the statistics are those of the round in which the class was created. """
         classId = item.getObjId()
         item.setAlignment3D()
-        directory = self._getExtraPath()
-        fnRep = ('%s/mltomo_ref00000%d.vol' % (directory, classId))
+        stats = self.classStats.get(classId, {'size': 0, 'meanPmax': 0., 'meanLL': 0.})
+        item.mltomoSize = Integer(stats['size'])
+        item.mltomoMeanPmax = Float(stats['meanPmax'])
+        item.mltomoMeanLL = Float(stats['meanLL'])
+        fnRep = self._getFileName('finalRef', ref=classId)
         representative = AverageSubTomogram()
         representative.setLocation(1, fnRep)
         representative.copyInfo(self.subtomoSet)
+        # MLTomo writes the references at the size of its input, downscaled only if the
+        # volumes were downscaled while converting them (-dim is applied internally)
+        representative.setSamplingRate(self.subtomoSet.getSamplingRate() *
+                                       self._getDownscaleFactor(self._getPreDownscDim()))
         representative.setClassId(classId)
         item.setRepresentative(representative)
 
+    @instrumented
     def _cleanFiles(self):
-        for iter in range(0, int(self.numberOfIters)+1):
-            os.remove(self._getExtraPath('mltomo_it00000%d.sel' % iter))
-            for ref in range(1, int(self.numberOfReferences)+1):
-                os.remove(self._getExtraPath('mltomo_it00000%d_ref00000%d.vol' % (iter, ref)))
-                os.remove(self._getExtraPath('mltomo_it00000%d_wedge00000%d.vol' % (iter, ref)))
-        for iter in range(1, int(self.numberOfIters)+1):
-            os.remove(self._getExtraPath('mltomo_it00000%d.fsc' % iter))
-
-        for ref in range(1, int(self.numberOfReferences) + 1):
-            if os.stat(self._getExtraPath('mltomo_it00000%d_ref00000%d.sel' % (self.numberOfIters, ref))).st_size == 0:
-                os.remove(self._getExtraPath('mltomo_it00000%d_ref00000%d.sel' % (self.numberOfIters, ref)))
-                os.remove(self._getExtraPath('mltomo_ref00000%d.vol' % ref))
-                continue
-            else:
+        """ Remove the files of the iterations but the docfile and the class sel files of
+        the last one, and the final references of the empty classes (those without
+        particles in the class index of the last docfile, see _loadDocData). The last
+        iteration is that of the loaded docfile. """
+        lastIter = int(ITER_DOC_REGEX.match(os.path.basename(self.fnDoc)).group(1))
+        for it, kind, ref, ext, fn in self._iterIterationFiles():
+            if it == lastIter and (ext == 'doc' or kind == 'ref' and ext == 'sel'):
+                if kind == 'ref' and ref not in self.classStats:
+                    os.remove(fn)
+                    cleanPath(self._getFileName('finalRef', ref=ref))
                 continue
-        for iter in range(1, int(self.numberOfIters)):
-            os.remove(self._getExtraPath('mltomo_it00000%d.doc' % iter))
-            for ref in range(1, int(self.numberOfReferences) + 1):
-                os.remove(self._getExtraPath('mltomo_it00000%d_ref00000%d.sel' % (iter, ref)))
+            os.remove(fn)
+
+
+class MLTomoMonitor(threading.Thread):
+    """ Watch the extra folder of a running Xmipp2ProtMLTomo, record the metrics of each
+    newly completed iteration and its FSC, and compact and prune the files of the older
+    ones (see Xmipp2ProtMLTomo._updateMetrics, _loadFscHistory, _compactIterations and
+    _pruneIterations). """
+
+    def __init__(self, protocol, sleepTime=10):
+        threading.Thread.__init__(self, daemon=True)
+        self.protocol = protocol
+        self.sleepTime = sleepTime
+        self.startTime = time.time()
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        while not self._stopEvent.wait(self.sleepTime):
+            self.update()
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+        self.update()
+
+    def update(self):
+        try:
+            self.protocol._updateMetrics(self.startTime)
+            self.protocol._loadFscHistory()
+            self.protocol._compactIterations()
+            self.protocol._pruneIterations()
+        except Exception as e:
+            # Monitoring must never break the run, files may be half written
+            self.protocol.warning("Could not update the iteration metrics or prune the iterations: %s" % e)
+
+
+class StepProfiler:
+    """ Context manager recording the wall and CPU time, bytes read and written and files
+    created in extra by a step of Xmipp2ProtMLTomo. The CPU time and I/O include the MLTomo
+    processes finished during the step. The peak RSS is not per step: it is the maximum
+    reached so far by the protocol process and by its largest child. The files are only
+    counted for the outermost step, not for the instrumented calls nested in it. The records
+    are appended to the steps file of extra (see Xmipp2ProtMLTomo._loadStepStats). If the
+    protocol profiles its steps, the cProfile statistics of the outermost step are dumped
+    to the profiles folder of extra. """
+
+    _lock = threading.Lock()
+
+    def __init__(self, protocol, step, args=()):
+        self.protocol = protocol
+        self.step = step
+        self.args = [arg for arg in args if isinstance(arg, (int, float, str))]
+        self.profile = None
+
+    def __enter__(self):
+        if self.protocol.profileSteps.get() and not getattr(self.protocol, '_profiling', False):
+            self.protocol._profiling = True
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.startTime = time.time()
+        self.startTimes = os.times()
+        self.startIO = self._readIO()
+        self.outermost = not getattr(self.protocol, '_instrumenting', False)
+        if self.outermost:
+            self.protocol._instrumenting = True
+            self.startFiles = self._countFiles()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        endTimes = os.times()
+        endIO = self._readIO()
+        wallTime = time.time() - self.startTime
+        if self.profile is not None:
+            self.profile.disable()
+            self.protocol._profiling = False
+            fnDir = self.protocol._getExtraPath(PROFILE_DIR)
+            makePath(fnDir)
+            self.profile.dump_stats(os.path.join(fnDir, '%s_%s.prof'
+                                                 % (self.step, '_'.join(str(arg) for arg in self.args) or 'all')))
+        files = None
+        if self.outermost:
+            self.protocol._instrumenting = False
+            files = self._countFiles()
+        # Linux reports the maximum resident set size in KB, macOS in bytes
+        rssUnit = 1 if sys.platform == 'darwin' else 1024
+        stats = {'step': self.step,
+                 'args': self.args,
+                 'start': self.startTime,
+                 'wallTime': wallTime,
+                 'cpuTime': sum(endTimes[:4]) - sum(self.startTimes[:4]),
+                 'processPeakRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rssUnit,
+                 'childrenPeakRss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rssUnit,
+                 'bytesRead': endIO[0] - self.startIO[0] if endIO else None,
+                 'bytesWritten': endIO[1] - self.startIO[1] if endIO else None,
+                 'files': files,
+                 'newFiles': None if files is None else files - self.startFiles,
+                 'failed': excType is not None}
+        try:
+            with self._lock:
+                self.protocol._addStepStats(stats)
+        except Exception as e:
+            # Instrumentation must never break the run
+            self.protocol.warning("Could not record the resources of %s: %s" % (self.step, e))
+        return False
+
+    @staticmethod
+    def _readIO():
+        """ Bytes read and written by the process and its finished children, None if the
+        system does not report them. """
+        try:
+            with open('/proc/self/io') as fhIO:
+                counters = dict(line.split(':') for line in fhIO)
+            return int(counters['rchar']), int(counters['wchar'])
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def _countFiles(self):
+        return sum(len(files) for _, _, files in os.walk(self.protocol._getExtraPath()))
@@ -0,0 +1,253 @@
+# **************************************************************************
+# *
+# * Authors:    Estrella Fernandez Gimenez [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmarks for the Python side of the plugin. They do not need the Xmipp 2.4
+binaries. Run them with:
+
+    python -m xmipp2.tests.benchmark_xmipp2 suite --output baseline.json
+    python -m xmipp2.tests.benchmark_xmipp2 suite --compare baseline.json
+    python -m xmipp2.tests.benchmark_xmipp2 conversion --help
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume, Transform
+from tomo.objects import SetOfSubTomograms, SubTomogram, TomoAcquisition
+from xmipp2.convert import writeSetOfVolumes, writeDocfile, eulerAngles2matrixBatch
+from xmipp2.protocols import Xmipp2ProtMLTomo
+
+# Tilt ranges of the synthetic subtomograms, one of them at random for each one
+WEDGES = [(-60, 60), (-60, 50), (-50, 60), (-45, 45)]
+
+
+def createVolumes(outputDir, n, size):
+    """ Write n random volumes of size^3 voxels in MRC format and return them as Volume objects. """
+    ih = ImageHandler()
+    image = ih.createImage()
+    volumes = []
+    for i in range(1, n + 1):
+        fn = os.path.join(outputDir, 'synthetic%06d.mrc' % i)
+        image.setData(np.random.normal(size=(size, size, size)).astype(np.float32))
+        image.write(fn)
+        volume = Volume(location=fn)
+        volume.setObjId(i)
+        volumes.append(volume)
+    return volumes
+
+
+def benchmarkConversion(n=200, size=64, procs=(1, 2, 4, 8)):
+    """ Time writeSetOfVolumes with a different number of processes. """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpDir:
+        volumes = createVolumes(tmpDir, n, size)
+        for numberOfProcs in procs:
+            outputDir = os.path.join(tmpDir, 'procs%d' % numberOfProcs)
+            os.makedirs(outputDir)
+            t0 = time.time()
+            writeSetOfVolumes(volumes, os.path.join(outputDir, 'subtomo'), numberOfProcs=numberOfProcs)
+            results[numberOfProcs] = time.time() - t0
+    return results
+
+
+def randomTransforms(n):
+    """ (n,4,4) matrices with random orientations and shifts. """
+    return eulerAngles2matrixBatch(np.random.uniform(-180, 180, n), np.random.uniform(0, 180, n),
+                                   np.random.uniform(-180, 180, n), *np.random.uniform(-5, 5, (3, n)))
+
+
+def createSyntheticSet(outputDir, n, size=8, numberOfFiles=100):
+    """ Write a set of n subtomograms with random transforms and wedges. The subtomograms
+    share numberOfFiles Spider volumes of size^3 voxels, so the conversion only links them. """
+    ih = ImageHandler()
+    image = ih.createImage()
+    fileNames = []
+    for i in range(min(n, numberOfFiles)):
+        fileNames.append(os.path.join(outputDir, 'synthetic%06d.vol' % i))
+        image.setData(np.random.normal(size=(size, size, size)).astype(np.float32))
+        image.write(fileNames[-1])
+    subtomoSet = SetOfSubTomograms(filename=os.path.join(outputDir, 'subtomograms%d.sqlite' % n))
+    subtomoSet.setSamplingRate(1.0)
+    wedges = np.random.randint(len(WEDGES), size=n)
+    for i, matrix in enumerate(randomTransforms(n)):
+        subtomo = SubTomogram()
+        subtomo.setLocation(fileNames[i % len(fileNames)])
+        subtomo.setSamplingRate(1.0)
+        acquisition = TomoAcquisition()
+        acquisition.setAngleMin(WEDGES[wedges[i]][0])
+        acquisition.setAngleMax(WEDGES[wedges[i]][1])
+        subtomo.setAcquisition(acquisition)
+        subtomo.setTransform(Transform(matrix))
+        subtomoSet.append(subtomo)
+    subtomoSet.write()
+    return subtomoSet
+
+
+def writeIterationFiles(protocol, numberOfIters, numberOfRefs, size=8):
+    """ Write the files of a MLTomo run of the protocol, without running it: iteration
+    docfiles with random assignments, sel files, FSCs and references. """
+    ih = ImageHandler()
+    image = ih.createImage()
+    image.setData(np.zeros((size, size, size), dtype=np.float32))
+    fileNames = [line.split()[0] for line in open(protocol._getFileName('inputSel'))]
+    n = len(fileNames)
+    objIds = np.arange(1, n + 1)
+    for it in range(numberOfIters + 1):
+        fnRefs = []
+        for ref in range(1, numberOfRefs + 1):
+            fnRefs.append(protocol._getFileName('iterRef', iter=it, ref=ref))
+            image.write(fnRefs[-1])
+            image.write(protocol._getFileName('iterWedge', iter=it, ref=ref))
+        if it:
+            classIds = np.random.randint(1, numberOfRefs + 1, size=n)
+            with open(protocol._getFileName('iterDoc', iter=it), 'w') as fhDoc:
+                writeDocfile(fhDoc, fileNames, objIds, randomTransforms(n), classIds, 1)
+            with open(protocol._getFileName('iterFsc', iter=it), 'w') as fhFsc:
+                fhFsc.writelines("%f 1.0\n" % (i / (2. * size)) for i in range(size // 2))
+            for ref in range(1, numberOfRefs + 1):
+                with open(protocol._getFileName('iterRefSel', iter=it, ref=ref), 'w') as fhRefSel:
+                    fhRefSel.writelines("%s 1\n" % fileNames[i] for i in np.flatnonzero(classIds == ref))
+        with open(protocol._getFileName('iterSel', iter=it), 'w') as fhSel:
+            fhSel.writelines("%s 1\n" % fnRef for fnRef in fnRefs)
+    for ref in range(1, numberOfRefs + 1):
+        image.write(protocol._getFileName('finalRef', ref=ref))
+
+
+def measure(function, *args, **kwargs):
+    """ Run function, return its wall time (s) and the peak of memory allocated (bytes). """
+    tracemalloc.start()
+    t0 = time.time()
+    try:
+        function(*args, **kwargs)
+        return {'time': time.time() - t0, 'peakMemory': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+
+def benchmarkSuite(sizes=(100, 10000, 100000), numberOfIters=3, numberOfRefs=4):
+    """ Time the Python hot paths of the plugin on synthetic sets of the given sizes.
+    Return {benchmark: {size: {'time', 'peakMemory'}}}. """
+    results = {}
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            subtomoSet = createSyntheticSet(tmpDir, n)
+            protocol = Xmipp2ProtMLTomo(workingDir=os.path.join(tmpDir, 'run'), useVolumeCache=False,
+                                        numberOfReferences=numberOfRefs)
+            protocol.inputVolumes.set(subtomoSet)
+            protocol._defineOutputs = lambda **kwargs: None
+            protocol._defineSourceRelation = lambda *args: None
+            protocol._createFilenameTemplates()
+            os.makedirs(protocol._getExtraPath('inputVolumes'))
+            outputDir = os.path.join(tmpDir, 'converted')
+            os.makedirs(outputDir)
+            fileNames = ['subtomo%06d.vol' % i for i in range(1, n + 1)]
+            matrices = randomTransforms(n)
+            objIds = np.arange(1, n + 1)
+            classIds = np.zeros(n, dtype=int)
+
+            def writeDoc():
+                with open(os.path.join(tmpDir, 'bench.doc'), 'w') as fhDoc:
+                    writeDocfile(fhDoc, fileNames, objIds, matrices, classIds, 1)
+
+            runs = [('writeSetOfVolumes', writeSetOfVolumes, (subtomoSet, os.path.join(outputDir, 'subtomo')),
+                     {'fnSel': os.path.join(outputDir, 'subtomograms.sel'),
+                      'fnDoc': os.path.join(outputDir, 'subtomograms.doc')}),
+                    ('_createFilesForMLTomo', protocol._createFilesForMLTomo, (), {}),
+                    ('writeDocfile', writeDoc, (), {}),
+                    ('writeIterationFiles', writeIterationFiles, (protocol, numberOfIters, numberOfRefs), {}),
+                    ('createOutput', protocol.createOutput, (), {})]
+            # createOutput would end removing the intermediate files, they are timed apart
+            protocol.cleanFiles.set(False)
+            runs.append(('_cleanFiles', protocol._cleanFiles, (), {}))
+            for name, function, args, kwargs in runs:
+                results.setdefault(name, {})[str(n)] = measure(function, *args, **kwargs)
+                print("%s %d: %0.2f s" % (name, n, results[name][str(n)]['time']))
+    return results
+
+
+def compareResults(results, baseline):
+    """ Print the ratio of time and peak memory of results against a baseline. """
+    for name, sizes in sorted(results.items()):
+        for n, result in sorted(sizes.items(), key=lambda item: int(item[0])):
+            base = baseline.get('results', {}).get(name, {}).get(n)
+            if base is None:
+                continue
+            print("%-22s %7s: time %0.2f s (x%0.2f), peak memory %0.1f MB (x%0.2f)"
+                  % (name, n, result['time'], result['time'] / max(base['time'], 1e-9),
+                     result['peakMemory'] / 1024. ** 2, result['peakMemory'] / max(base['peakMemory'], 1)))
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the xmipp2 plugin")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    suite = subparsers.add_parser('suite', help="Time the Python hot paths on synthetic sets")
+    suite.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                       help="Number of subtomograms of the synthetic sets")
+    suite.add_argument('--output', help="Write the results to this JSON file")
+    suite.add_argument('--compare', help="JSON file of a previous run to compare with")
+    conversion = subparsers.add_parser('conversion', help="Compare the number of conversion processes")
+    conversion.add_argument('-n', type=int, default=200, help="Number of volumes")
+    conversion.add_argument('--size', type=int, default=64, help="Box size of the volumes")
+    conversion.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help="Number of conversion processes to compare")
+    args = parser.parse_args()
+
+    if args.benchmark == 'conversion':
+        results = benchmarkConversion(args.n, args.size, args.procs)
+        serial = results.get(1)
+        for numberOfProcs, elapsed in results.items():
+            speedup = " (x%0.2f)" % (serial / elapsed) if serial else ""
+            print("writeSetOfVolumes %d volumes of %d^3, %d processes: %0.2f s%s"
+                  % (args.n, args.size, numberOfProcs, elapsed, speedup))
+    elif args.benchmark == 'suite':
+        results = benchmarkSuite(args.sizes)
+        if args.compare:
+            with open(args.compare) as fhBaseline:
+                compareResults(results, json.load(fhBaseline))
+        if args.output:
+            with open(args.output, 'w') as fhOutput:
+                json.dump({'commit': getCommit(), 'python': sys.version.split()[0], 'date': time.ctime(),
+                           'results': results}, fhOutput, indent=1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+# **************************************************************************
+# *
+# * Authors:    Estrella Fernandez Gimenez [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import io
+import math
+import os
+from unittest import mock
+import numpy as np
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pwem.objects import Transform
+from tomo.objects import SetOfSubTomograms, SubTomogram
+from xmipp2.convert import (eulerAngles2matrix, eulerAngles2matrixBatch, matrix2eulerAngles,
+                            matrix2eulerAnglesBatch, writeDocfile, iterDocfile, readDocfileArray,
+                            writeSetOfVolumes, VolumeCache, iterationStats, angularDistance, readSelFile,
+                            splitDocfile, mergeDocfiles, mergeVolumes, fourierCrop, fourierPad, getDownscaledDim,
+                            VolumeHistory, readHistoryVolume, docfileMatrices, classStatistics, readFscFile,
+                            mergeFscFiles, loadFscHistory, fscResolution, DOC_DTYPE)
+
+
+def _eulerAngles2matrix(alpha, beta, gamma, shiftx, shifty, shiftz):
+    """ Reference scalar implementation of Xmipp Euler_angles2matrix (ZYZ, degrees). """
+    sa, ca = math.sin(math.radians(alpha)), math.cos(math.radians(alpha))
+    sb, cb = math.sin(math.radians(beta)), math.cos(math.radians(beta))
+    sg, cg = math.sin(math.radians(gamma)), math.cos(math.radians(gamma))
+    return np.array([[cg * cb * ca - sg * sa, cg * cb * sa + sg * ca, -cg * sb, shiftx],
+                     [-sg * cb * ca - cg * sa, -sg * cb * sa + cg * ca, sg * sb, shifty],
+                     [sb * ca, sb * sa, cb, shiftz],
+                     [0, 0, 0, 1]])
+
+
+def _matrix2eulerAngles(A):
+    """ Reference scalar implementation of Xmipp Euler_matrix2angles. """
+    abs_sb = math.sqrt(A[0, 2] ** 2 + A[1, 2] ** 2)
+    if abs_sb > 16 * math.exp(-5):
+        gamma = math.atan2(A[1, 2], -A[0, 2])
+        alpha = math.atan2(A[2, 1], A[2, 0])
+        if abs(math.sin(gamma)) < math.exp(-5):
+            sign_sb = np.sign(-A[0, 2] / math.cos(gamma))
+        else:
+            sign_sb = np.sign(A[1, 2]) if math.sin(gamma) > 0 else -np.sign(A[1, 2])
+        beta = math.atan2(sign_sb * abs_sb, A[2, 2])
+    elif A[2, 2] > 0:
+        alpha, beta, gamma = 0, 0, math.atan2(-A[1, 0], A[0, 0])
+    else:
+        alpha, beta, gamma = 0, math.pi, math.atan2(A[1, 0], -A[0, 0])
+    return math.degrees(alpha), math.degrees(beta), math.degrees(gamma), A[0, 3], A[1, 3], A[2, 3]
+
+
+class TestXmipp2Convert(BaseTest):
+    """This class check if the conversion functions in xmipp2 work properly"""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createSubtomograms(self, n, name='subtomograms.sqlite'):
+        np.random.seed(1)
+        subtomos = SetOfSubTomograms(filename=self.getOutputPath(name))
+        subtomos.setSamplingRate(2.0)
+        for i in range(n):
+            subtomo = SubTomogram()
+            subtomo.setLocation(self.getOutputPath('subtomo.mrc'))
+            rot, tilt, psi = np.random.uniform(-180, 180, 3)
+            subtomo.setTransform(Transform(eulerAngles2matrix(rot, tilt, psi, *np.random.normal(size=3))))
+            subtomo.setClassId(i % 3)
+            subtomos.append(subtomo)
+        subtomos.write()
+        return subtomos
+
+    def test_eulerBatch(self):
+        # Fixed rotations: 90 degrees around Z (gimbal lock) and around Y
+        matrices = eulerAngles2matrixBatch([90, 0], [0, 90], [0, 0], [1, 0], [2, 0], [3, 0])
+        self.assertTrue(np.allclose(matrices, [[[0, 1, 0, 1], [-1, 0, 0, 2], [0, 0, 1, 3], [0, 0, 0, 1]],
+                                               [[0, 0, -1, 0], [0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 1]]]))
+        angles = matrix2eulerAnglesBatch(matrices)
+        self.assertTrue(np.allclose(angles, [[0, 0], [0, 90], [90, 0], [1, 0], [2, 0], [3, 0]]))
+        # Random angles against the scalar formulas of Xmipp
+        np.random.seed(0)
+        n = 200
+        rot, tilt, psi = np.random.uniform(-180, 180, (3, n))
+        tilt[::4] = 0  # gimbal lock, positive branch
+        tilt[1::4] = 180  # gimbal lock, negative branch
+        shiftx, shifty, shiftz = np.random.normal(size=(3, n))
+        matrices = eulerAngles2matrixBatch(rot, tilt, psi, shiftx, shifty, shiftz)
+        self.assertEqual(matrices.shape, (n, 4, 4))
+        angles = matrix2eulerAnglesBatch(matrices)
+        for i in range(n):
+            A = _eulerAngles2matrix(rot[i], tilt[i], psi[i], shiftx[i], shifty[i], shiftz[i])
+            self.assertTrue(np.allclose(A, matrices[i]))
+            self.assertTrue(np.allclose(A, eulerAngles2matrix(rot[i], tilt[i], psi[i],
+                                                              shiftx[i], shifty[i], shiftz[i])))
+            self.assertTrue(np.allclose([x[i] for x in angles], _matrix2eulerAngles(A)))
+            self.assertTrue(np.allclose(matrix2eulerAngles(A), _matrix2eulerAngles(A)))
+        # Angles may differ but the rotation must be the same (out of the gimbal lock threshold)
+        back = eulerAngles2matrixBatch(*angles)
+        valid = np.logical_or(np.abs(np.sin(np.deg2rad(tilt))) > 0.2, np.sin(np.deg2rad(tilt)) == 0)
+        self.assertTrue(np.allclose(back[valid], matrices[valid]))
+
+    def test_writeDocfile(self):
+        subtomos = self._createSubtomograms(20)
+        fileNames = ['inputVolumes/subtomo%06d.vol' % subtomo.getObjId() for subtomo in subtomos]
+        matrices = np.array([subtomo.getTransform().getMatrix() for subtomo in subtomos])
+        fhDoc = io.StringIO()
+        writeDocfile(fhDoc, fileNames, list(range(1, 21)), matrices, [i % 3 for i in range(20)], 1)
+        lines = fhDoc.getvalue().splitlines()
+        self.assertEqual(len(lines), 1 + 2 * 20)
+        self.assertEqual(lines[-2], ' ; inputVolumes/subtomo000020.vol')
+        values = lines[-1].split()
+        self.assertEqual(int(values[0]), 20)
+        rot, tilt, psi, shiftx, shifty, shiftz = matrix2eulerAngles(matrices[-1])
+        self.assertAlmostEqual(float(values[2]), rot, places=5)
+        self.assertAlmostEqual(float(values[5]), -shiftx, places=5)
+        self.assertEqual(values[8:10], ['1', '1'])
+
+    def test_writeSetOfVolumesSelDoc(self):
+        outputDir = self.getOutputPath('seldoc')
+        os.makedirs(outputDir)
+        volumes = self._createVolumes(4, '.mrc')
+        volumes[2].setTransform(Transform(eulerAngles2matrix(10, 20, 30, 1, 2, 3)))
+        volumes[2].setClassId(2)
+        fnSel = os.path.join(outputDir, 'subtomograms.sel')
+        fnDoc = os.path.join(outputDir, 'subtomograms.doc')
+        writeSetOfVolumes(volumes, os.path.join(outputDir, 'subtomo'), fnSel=fnSel, fnDoc=fnDoc,
+                          wedge=lambda volume: 1 + volume.getObjId() % 2)
+        with open(fnSel) as fhSel:
+            self.assertEqual(fhSel.read().splitlines(),
+                             ['%s%06d.vol 1' % (os.path.join(outputDir, 'subtomo'), i) for i in range(1, 5)])
+        data = readDocfileArray(fnDoc)
+        self.assertEqual(data['id'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(data['ref'].tolist(), [0, 0, 2, 0])
+        self.assertEqual(data['wedge'].tolist(), [2, 1, 2, 1])
+        self.assertTrue(np.allclose([data['rot'][2], data['tilt'][2], data['psi'][2], data['xoff'][2]],
+                                    [10, 20, 30, -1]))
+
+    def test_readDocfileArray(self):
+        fnDoc = self.getOutputPath('mltomo_it000003.doc')
+        with open(fnDoc, 'w') as fhDoc:
+            fhDoc.write(" ; Headerinfo columns: rot (1), tilt (2), psi (3), Xoff (4), Yoff (5), Zoff (6), Ref (7), "
+                        "Wedge (8), Pmax/sumP (9), LL (10)\n")
+            for i, objId in enumerate([7, 3, 12, 5, 9]):
+                fhDoc.write(" ; extra/inputVolumes/subtomo%06d.vol\n" % objId)
+                fhDoc.write("%5d 10 %f %f %f %f %f %f %d %d %f %f\n" % (i + 1, objId * 10., 20., 30., -1.5, 0, 2.,
+                                                                       objId % 2 + 1, 1, 0.25, -1000. * objId))
+        data = readDocfileArray(fnDoc)
+        self.assertEqual(data['id'].tolist(), [7, 3, 12, 5, 9])
+        self.assertEqual(data['ref'].tolist(), [2, 2, 1, 2, 2])
+        self.assertEqual(data['rot'][2], 120.)
+        self.assertEqual(data['xoff'][0], -1.5)
+        self.assertEqual(data['ll'][4], -9000.)
+        chunks = list(iterDocfile(fnDoc, chunkSize=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertTrue(np.array_equal(np.concatenate(chunks), data))
+        mapped = readDocfileArray(fnDoc, mmap=True)
+        self.assertIsInstance(mapped, np.memmap)
+        self.assertTrue(np.array_equal(mapped, data))
+        matrices = docfileMatrices(data)
+        self.assertTrue(np.allclose(matrices[2], eulerAngles2matrix(120., 20., 30., 1.5, 0, -2.)))
+        # A docfile with only the header has no rows
+        fnEmpty = self.getOutputPath('empty.doc')
+        with open(fnEmpty, 'w') as fhDoc:
+            fhDoc.write(" ; Headerinfo columns: rot (1), tilt (2), psi (3)\n")
+        empty = readDocfileArray(fnEmpty)
+        self.assertEqual(empty.dtype, DOC_DTYPE)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(docfileMatrices(empty).shape, (0, 4, 4))
+
+    def _createVolumes(self, n, ext, size=8):
+        ih = ImageHandler()
+        image = ih.createImage()
+        volumes = []
+        for i in range(1, n + 1):
+            fn = self.getOutputPath('volume%d%s' % (i, ext))
+            image.setData(np.random.normal(size=(size, size, size)).astype(np.float32))
+            image.write(fn)
+            volume = Volume(location=fn)
+            volume.setObjId(i)
+            volumes.append(volume)
+        return volumes
+
+    def test_writeSetOfVolumesCache(self):
+        outputDir = self.getOutputPath('cached')
+        os.makedirs(outputDir)
+        cache = VolumeCache(self.getOutputPath('cache'), 1024 ** 3)
+        volumes = self._createVolumes(3, '.mrc') + self._createVolumes(1, '.vol')
+        volumes[-1].setObjId(4)
+        writeSetOfVolumes(volumes, os.path.join(outputDir, 'subtomo'), numberOfProcs=2, cache=cache)
+        self.assertTrue(os.path.islink(os.path.join(outputDir, 'subtomo000004.vol')))
+        self.assertEqual(len(os.listdir(cache.path)), 3)
+        fnOutput = os.path.join(outputDir, 'subtomo000001.vol')
+        self.assertTrue(os.path.samefile(fnOutput, cache.getEntry(volumes[0].getLocation())))
+        self.assertTrue(np.allclose(ImageHandler().read(fnOutput).getData(),
+                                    ImageHandler().read(volumes[0].getLocation()).getData()))
+        # A second run takes the volumes from the cache, and eviction keeps only one
+        cache.maxSize = os.path.getsize(fnOutput)
+        os.utime(cache.getEntry(volumes[2].getLocation()), (0, 0))
+        writeSetOfVolumes(volumes[1:2], os.path.join(outputDir, 'subtomo'), cache=cache)
+        self.assertEqual(os.listdir(cache.path), [os.path.basename(cache.getEntry(volumes[1].getLocation()))])
+        # An entry evicted by another run sharing the cache, between finding it and linking it,
+        # is converted again, and evicting it again does not fail
+        entry = cache.getEntry(volumes[1].getLocation())
+
+        def evictedUtime(fn, *args):
+            os.remove(fn)
+            raise FileNotFoundError(fn)
+
+        with mock.patch.object(os, 'utime', side_effect=evictedUtime):
+            cache.convert(volumes[1].getLocation(), fnOutput)
+        self.assertTrue(os.path.samefile(fnOutput, entry))
+        remove = os.remove
+
+        def evictedRemove(fn):
+            remove(fn)
+            remove(fn)
+
+        cache.maxSize = 0
+        with mock.patch.object(os, 'remove', side_effect=evictedRemove):
+            cache.evict()
+        self.assertEqual(os.listdir(cache.path), [])
+
+    def test_iterationStats(self):
+        previous = np.zeros(4, dtype=DOC_DTYPE)
+        previous['id'] = [1, 2, 3, 4]
+        previous['ref'] = [1, 1, 2, 2]
+        data = np.zeros(4, dtype=DOC_DTYPE)
+        data['id'] = [4, 3, 2, 1]
+        data['ref'] = [2, 1, 1, 1]
+        data['pmax'] = [0.1, 0.2, 0.3, 0.4]
+        data['ll'] = [-10, -20, -30, -40]
+        data['rot'] = [0, 10, 90, 30]
+        self.assertTrue(np.allclose(angularDistance(data, previous), [0, 10, 90, 30]))
+        stats = iterationStats(data, previous)
+        self.assertEqual(stats['occupancy'], {'1': 3, '2': 1})
+        self.assertEqual(stats['meanLL'], -25)
+        self.assertAlmostEqual(stats['pmax']['median'], 0.25)
+        self.assertEqual(stats['changedClass'], 0.25)
+        self.assertAlmostEqual(stats['medianAngleChange'], 20)
+        self.assertNotIn('changedClass', iterationStats(data))
+        self.assertNotIn('changedOrientation', stats)
+        self.assertEqual(iterationStats(data, previous, angularStep=15)['changedOrientation'], 0.5)
+        classStats = classStatistics(data)
+        self.assertEqual(sorted(classStats), [1, 2])
+        self.assertEqual(classStats[1]['size'], 3)
+        self.assertAlmostEqual(classStats[1]['meanPmax'], 0.3)
+        self.assertEqual(classStats[2]['meanLL'], -10)
+
+    def test_shards(self):
+        outputDir = self.getOutputPath('shards')
+        os.makedirs(outputDir)
+        volumes = self._createVolumes(5, '.mrc')
+        fnSel = os.path.join(outputDir, 'subtomograms.sel')
+        fnDoc = os.path.join(outputDir, 'subtomograms.doc')
+        writeSetOfVolumes(volumes, os.path.join(outputDir, 'subtomo'), fnSel=fnSel, fnDoc=fnDoc)
+        fnShards = [(os.path.join(outputDir, 'shard%d.sel' % i), os.path.join(outputDir, 'shard%d.doc' % i))
+                    for i in range(2)]
+        splitDocfile(fnSel, fnDoc, fnShards)
+        self.assertEqual([len(readSelFile(fnShardSel)) for fnShardSel, _ in fnShards], [3, 2])
+        self.assertEqual(readDocfileArray(fnShards[1][1])['id'].tolist(), [4, 5])
+        # Merging the shards in reverse order restores the order of the sel file
+        fnMerged = os.path.join(outputDir, 'merged.doc')
+        mergeDocfiles([fnShardDoc for _, fnShardDoc in reversed(fnShards)], fnSel, fnMerged)
+        self.assertEqual(readDocfileArray(fnMerged)['id'].tolist(), [1, 2, 3, 4, 5])
+
+        fnVols = [volume.getFileName() for volume in volumes[:2]]
+        fnAverage = os.path.join(outputDir, 'average.vol')
+        mergeVolumes(fnVols, [3, 1], fnAverage)
+        data = [ImageHandler().read(fn).getData() for fn in fnVols + [fnAverage]]
+        self.assertTrue(np.allclose(data[2], 0.75 * data[0] + 0.25 * data[1], atol=1e-5))
+        mergeVolumes(fnVols, [0, 0], fnAverage)
+        self.assertTrue(np.allclose(ImageHandler().read(fnAverage).getData(), 0.5 * (data[0] + data[1]), atol=1e-5))
+
+        fnFscs = []
+        for shard, values in enumerate([(1., 0.2), (0.6, 0.4)]):
+            fnFscs.append(os.path.join(outputDir, 'shard%d.fsc' % shard))
+            with open(fnFscs[-1], 'w') as fhFsc:
+                fhFsc.write("# freq. FSC refs 1-2\n0.125 %f %f\n0.25 %f %f\n" % (values * 2))
+        fnFsc = os.path.join(outputDir, 'merged.fsc')
+        mergeFscFiles(fnFscs, [[3, 0], [1, 0]], fnFsc)
+        freq, fsc = readFscFile(fnFsc)
+        self.assertTrue(np.allclose(freq, [0.125, 0.25]))
+        self.assertTrue(np.allclose(fsc, [[0.9, 0.9], [0.3, 0.3]]))
+
+    def test_downscale(self):
+        # A low frequency wave is kept, only sampled with less voxels
+        x = np.arange(16)
+        wave = np.cos(2 * np.pi * x / 8)[None, None, :] + np.zeros((16, 16, 16))
+        cropped = fourierCrop(wave, 8)
+        self.assertEqual(cropped.shape, (8, 8, 8))
+        self.assertTrue(np.allclose(cropped[3, 5], np.cos(2 * np.pi * np.arange(8) / 4), atol=1e-5))
+        self.assertAlmostEqual(float(fourierCrop(wave + 2, 6).mean()), 2, places=5)
+        self.assertTrue(np.allclose(fourierPad(cropped, 16), wave, atol=1e-5))
+        self.assertEqual(getDownscaledDim(100, 2.0, 20.0), 20)
+        self.assertEqual(getDownscaledDim(100, 2.0, 18.0), 24)
+        self.assertEqual(getDownscaledDim(100, 2.0, 2.0), 100)
+
+        outputDir = self.getOutputPath('downscaled')
+        os.makedirs(outputDir)
+        cache = VolumeCache(self.getOutputPath('downscaledCache'), 1024 ** 3)
+        volumes = self._createVolumes(2, '.vol')
+        volumes[1].setTransform(Transform(eulerAngles2matrix(0, 0, 0, 2, 4, 6)))
+        fnDoc = os.path.join(outputDir, 'subtomograms.doc')
+        writeSetOfVolumes(volumes, os.path.join(outputDir, 'subtomo'), cache=cache, fnDoc=fnDoc, downscale=4)
+        fnOutput = os.path.join(outputDir, 'subtomo000001.vol')
+        self.assertEqual(ImageHandler().read(fnOutput).getData().shape, (4, 4, 4))
+        self.assertTrue(os.path.samefile(fnOutput, cache.getEntry(volumes[0].getLocation(), 4)))
+        self.assertTrue(np.allclose(readDocfileArray(fnDoc)['xoff'], [0, -1]))
+
+
+    def test_volumeHistory(self):
+        volumes = self._createVolumes(3, '.vol')
+        fns = [volume.getFileName() for volume in volumes]
+        history = VolumeHistory(self.getOutputPath('history'))
+        history.add(1, {1: fns[0], 2: fns[1]}, {1: fns[2], 2: fns[2]})
+        history.add(2, {1: fns[1], 2: fns[0]})
+        self.assertEqual(history.getIterations(), [1, 2])
+        self.assertEqual(history.getReferences(2), [1, 2])
+        self.assertIn((1, 2), history)
+        self.assertNotIn((2, 3), history)
+        data = ImageHandler().read(fns[0]).getData()
+        volume = readHistoryVolume(self.getOutputPath('history'), 2, 2)
+        self.assertEqual(volume.dtype, np.float32)
+        self.assertTrue(np.allclose(volume, data, atol=1e-2))
+        self.assertTrue(np.allclose(history.read(1, 2, 'wedge'), ImageHandler().read(fns[2]).getData(), atol=1e-2))
+
+    def test_fscHistory(self):
+        fnFscs = {}
+        for it, numberOfFreqs in [(1, 4), (2, 3)]:
+            fnFscs[it] = self.getOutputPath('mltomo_it%06d.fsc' % it)
+            with open(fnFscs[it], 'w') as fhFsc:
+                fhFsc.write("# freq. FSC refs 1-2\n")
+                for i in range(numberOfFreqs):
+                    fhFsc.write("%f %f %f\n" % ((i + 1) / 8., 1 - 0.3 * i, 1 - 0.2 * i * it))
+        freq, fsc = readFscFile(fnFscs[1])
+        self.assertTrue(np.allclose(freq, [0.125, 0.25, 0.375, 0.5]))
+        self.assertEqual(fsc.shape, (2, 4))
+        fnCache = self.getOutputPath('fsc.npz')
+        iterations, freq, fsc = loadFscHistory(fnFscs, fnCache)
+        self.assertEqual(iterations.tolist(), [1, 2])
+        self.assertEqual(fsc.shape, (2, 2, 4))
+        self.assertTrue(np.isnan(fsc[1, 0, 3]))
+        # The cache keeps the iterations whose files are removed
+        os.remove(fnFscs[1])
+        cached = loadFscHistory({2: fnFscs[2]}, fnCache)
+        self.assertTrue(all(np.array_equal(a, b, equal_nan=True) for a, b in zip(cached, (iterations, freq, fsc))))
+        resolution = fscResolution(freq[:, None, :], fsc)
+        self.assertTrue(np.allclose(resolution, [[1 / 3., 0.4375], [1 / 3., 0.28125]]))
+
+    def test_mockMLTomo(self):
+        from xmipp2.mock.ml_tomo import main
+        outputDir = self.getOutputPath('mock')
+        os.makedirs(outputDir)
+        fnSel = os.path.join(outputDir, 'subtomograms.sel')
+        fnDoc = os.path.join(outputDir, 'subtomograms.doc')
+        writeSetOfVolumes(self._createVolumes(3, '.vol'), os.path.join(outputDir, 'subtomo'),
+                          fnSel=fnSel, fnDoc=fnDoc)
+        fnRoot = os.path.join(outputDir, 'mltomo')
+        main(['-i', fnSel, '-doc', fnDoc, '-o', fnRoot, '-nref', '2', '-iter', '2', '-dim', '4', '-dont_align'])
+        data = readDocfileArray(fnRoot + '_it000002.doc')
+        self.assertEqual(list(data['id']), [1, 2, 3])
+        self.assertTrue(set(data['ref']) <= {1, 2})
+        self.assertEqual(readSelFile(fnRoot + '_it000002.sel'),
+                         [fnRoot + '_it000002_ref%06d.vol' % ref for ref in [1, 2]])
+        # -dim is applied internally: the references keep the input size, the FSC is downscaled
+        self.assertEqual(ImageHandler().getDimensions(fnRoot + '_ref000002.vol')[:3], (8, 8, 8))
+        self.assertEqual(np.loadtxt(fnRoot + '.fsc').shape, (2, 3))
@@ -24,10 +24,23 @@
 # *
 # **************************************************************************
 
+import os
+import tarfile
+import time
+import numpy as np
+from pwem.emlib.image import ImageHandler
+from pyworkflow.object import Set
+from pyworkflow.protocol.constants import MODE_RESUME, MODE_RESTART
 from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import makePath
+from tomo.objects import SetOfSubTomograms
 from tomo.protocols import ProtImportSubTomograms
 from tomo.tests import DataSet
+from xmipp2 import Plugin
+from xmipp2.convert import readDocfileArray
+from xmipp2.mock.ml_tomo import main as mockMLTomo
 from xmipp2.protocols import Xmipp2ProtMLTomo
+from xmipp2.protocols.protocol_mltomo import MLTomoMonitor
 
 
 class TestXmipp2Mltomo(BaseTest):
@@ -69,3 +82,415 @@ class TestXmipp2Mltomo(BaseTest):
         self.assertTrue(outputClasses)
         self.assertTrue(outputClasses.hasRepresentatives())
         return protMltomo
+
+
+class TestXmipp2MltomoMock(BaseTest):
+    """ Check the MLTomo pipeline (conversion, iterations and outputs) with the mock of
+    xmipp_ml_tomo, so Xmipp 2.4 does not need to be installed. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = os.environ.copy()
+        os.environ.update(XMIPP2_MOCK='1', XMIPP2_MOCK_SEED='1')
+        Plugin._defineVariables()
+        setupTestProject(cls)
+        fnDir = cls.getOutputPath('subtomograms')
+        os.makedirs(fnDir)
+        image = ImageHandler().createImage()
+        rng = np.random.RandomState(0)
+        for i in range(12):
+            image.setData(rng.normal(size=(10, 10, 10)).astype(np.float32))
+            image.write(os.path.join(fnDir, 'subtomo%02d.mrc' % i))
+        cls.protImport = cls.newProtocol(ProtImportSubTomograms, filesPath=fnDir, filesPattern='*.mrc',
+                                         samplingRate=5)
+        cls.launchProtocol(cls.protImport)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.clear()
+        os.environ.update(cls.environ)
+        Plugin._defineVariables()
+
+    def _runMltomo(self, label, **kwargs):
+        kwargs.setdefault('numberOfReferences', 2)
+        kwargs.setdefault('numberOfIters', 3)
+        kwargs.setdefault('cleanFiles', False)
+        kwargs.setdefault('numberOfMpi', 1)
+        kwargs.setdefault('inputVolumes', self.protImport.outputSubTomograms)
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, objLabel=label, **kwargs)
+        self.launchProtocol(protMltomo)
+        return protMltomo
+
+    def _newMltomo(self, label, **kwargs):
+        """ Saved protocol, not launched, with its input converted. The iterations are written
+        in the test process by the mock (see _runMockIterations). """
+        kwargs.setdefault('numberOfReferences', 2)
+        kwargs.setdefault('inputVolumes', self.protImport.outputSubTomograms)
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, objLabel=label, **kwargs)
+        self.proj.saveProtocol(protMltomo)
+        makePath(protMltomo._getExtraPath('inputVolumes'))
+        protMltomo._createFilenameTemplates()
+        protMltomo._createFilesForMLTomo()
+        return protMltomo
+
+    def _runMockIterations(self, protMltomo, iStart, iEnd):
+        mockMLTomo(protMltomo._getMLTomoArgs(iStart, iEnd).split())
+
+    def _checkOutputs(self, protMltomo, numberOfIters):
+        self.assertSetSize(protMltomo.outputSubtomograms, 12)
+        self.assertTrue(protMltomo.outputSubtomograms.getFirstItem().hasTransform())
+        self.assertTrue(protMltomo.outputClassesSubtomo.hasRepresentatives())
+        self.assertEqual(sum(classSubtomo.getSize() for classSubtomo in protMltomo.outputClassesSubtomo), 12)
+        self.assertEqual([stats['iteration'] for stats in protMltomo._loadMetrics()],
+                         list(range(1, numberOfIters + 1)))
+
+    def _iterationFiles(self, protMltomo, ext):
+        return sorted(it for it, _, _, fileExt, _ in protMltomo._iterIterationFiles() if fileExt == ext)
+
+    def test_resume(self):
+        protMltomo = self._runMltomo('resume', iterationsPerStep=1)
+        self._checkOutputs(protMltomo, 3)
+        runs = [stats['args'] for stats in protMltomo._loadStepStats() if stats['step'] == 'runMLTomo']
+        self.assertEqual(runs, [[1, 1, 0], [2, 2, 0], [3, 3, 0]])
+        # Continuing with more iterations only runs the new ones
+        protMltomo.numberOfIters.set(5)
+        protMltomo.runMode.set(MODE_RESUME)
+        self.launchProtocol(protMltomo)
+        self._checkOutputs(protMltomo, 5)
+        runs = [stats['args'] for stats in protMltomo._loadStepStats() if stats['step'] == 'runMLTomo']
+        self.assertEqual(runs[3:], [[4, 4, 0], [5, 5, 0]])
+
+    def test_resumeLastIteration(self):
+        protMltomo = self._newMltomo('resume files', numberOfIters=5, iterationsPerStep=2)
+        protMltomo._insertAllSteps()
+        self.assertEqual([(step.funcName.get(), step.argsStr.get()) for step in protMltomo._steps],
+                         [('convertInputStep', '[]'), ('runMLTomo', '[1, 2, 0]'), ('runMLTomo', '[3, 4, 0]'),
+                          ('runMLTomo', '[5, 5, 0]'), ('createOutput', '[]')])
+        self.assertEqual(protMltomo._getLastIteration(), 0)
+        self._runMockIterations(protMltomo, 1, 3)
+        self.assertEqual(protMltomo._getLastIteration(), 3)
+        # An iteration killed while writing its references or its docfile is not complete
+        os.remove(protMltomo._getFileName('iterRef', iter=3, ref=2))
+        self.assertEqual(protMltomo._getLastIteration(), 2)
+        with open(protMltomo._getFileName('iterDoc', iter=2)) as fhDoc:
+            lines = fhDoc.readlines()
+        with open(protMltomo._getFileName('iterDoc', iter=2), 'w') as fhDoc:
+            fhDoc.writelines(lines[:-2])
+        self.assertEqual(protMltomo._getLastIteration(), 1)
+        # The run continues from the docfile and references of the last complete iteration
+        args = protMltomo._getMLTomoArgs(2, 4).split()
+        self.assertEqual(args[args.index('-istart') + 1], '2')
+        self.assertEqual(args[args.index('-doc') + 1], protMltomo._getFileName('iterDoc', iter=1))
+        self.assertEqual(args[args.index('-ref') + 1], protMltomo._getFileName('iterSel', iter=1))
+        self._runMockIterations(protMltomo, 2, 4)
+        self.assertEqual(protMltomo._getLastIteration(), 4)
+
+    def test_earlyStop(self):
+        # The class changes of the mock are always below 100%, it converges in the first
+        # iteration with statistics of changes
+        protMltomo = self._runMltomo('early stop', numberOfIters=5, iterationsPerStep=1, doEarlyStop=True,
+                                     convClassChange=1, convAngleChange=1000)
+        self.assertEqual(protMltomo.convergedIteration.get(), 2)
+        self._checkOutputs(protMltomo, 2)
+        # Restarted without early stop, it runs all the iterations
+        protMltomo.doEarlyStop.set(False)
+        protMltomo.runMode.set(MODE_RESTART)
+        self.launchProtocol(protMltomo)
+        self.assertFalse(protMltomo.convergedIteration.hasValue())
+        self._checkOutputs(protMltomo, 5)
+
+    def test_metrics(self):
+        protMltomo = self._newMltomo('metrics', numberOfIters=4)
+        startTime = time.time()
+        self._runMockIterations(protMltomo, 1, 2)
+        # A docfile still being written is not recorded
+        with open(protMltomo._getFileName('iterDoc', iter=2)) as fhDoc:
+            lines = fhDoc.readlines()
+        with open(protMltomo._getFileName('iterDoc', iter=3), 'w') as fhDoc:
+            fhDoc.writelines(lines[:-2])
+        protMltomo._updateMetrics(startTime)
+        metrics = protMltomo._loadMetrics()
+        self.assertEqual([stats['iteration'] for stats in metrics], [1, 2])
+        data = readDocfileArray(protMltomo._getFileName('iterDoc', iter=2))
+        self.assertAlmostEqual(metrics[1]['meanLL'], np.mean(data['ll']), places=4)
+        self.assertAlmostEqual(metrics[1]['pmax']['median'], np.median(data['pmax']), places=4)
+        self.assertEqual(sum(metrics[1]['occupancy'].values()), 12)
+        # The changes are those from the previous iteration, there is no docfile before the first one
+        self.assertNotIn('changedClass', metrics[0])
+        self.assertIn('changedClass', metrics[1])
+        self.assertTrue(all(stats['wallTime'] >= 0 for stats in metrics))
+        # The monitor records the new iterations while MLTomo runs
+        monitor = MLTomoMonitor(protMltomo, sleepTime=0.1)
+        monitor.start()
+        self._runMockIterations(protMltomo, 3, 4)
+        monitor.stop()
+        self.assertEqual(protMltomo._loadMetrics()[:2], metrics)
+        self.assertEqual([stats['iteration'] for stats in protMltomo._loadMetrics()], [1, 2, 3, 4])
+        self.assertTrue(any(line.startswith("Iteration *4*") for line in protMltomo.summary()))
+
+    def test_pruning(self):
+        protMltomo = self._runMltomo('pruning', numberOfIters=5, iterationsPerStep=1, keepLastIters=1,
+                                     keepEveryIter=2, archiveKeptIters=True)
+        self._checkOutputs(protMltomo, 5)
+        self.assertEqual(self._iterationFiles(protMltomo, 'doc'), [5])
+        self.assertEqual(sorted(os.listdir(protMltomo._getExtraPath('archive'))),
+                         ['mltomo_it%06d.tar.gz' % it for it in [0, 2, 4]])
+
+    def test_pruningFiles(self):
+        # More than 9 iterations and references, the files are matched whatever their number
+        protMltomo = self._newMltomo('pruning files', numberOfReferences=12, numberOfIters=11, keepLastIters=2,
+                                     keepEveryIter=5, archiveKeptIters=True)
+        self._runMockIterations(protMltomo, 1, 11)
+        # Nothing is pruned before the metrics of the iterations are recorded
+        protMltomo._pruneIterations()
+        self.assertEqual(sorted(set(self._iterationFiles(protMltomo, 'vol'))), list(range(12)))
+        protMltomo._updateMetrics(0)
+        protMltomo._pruneIterations()
+        for ext in ['vol', 'sel', 'doc', 'fsc']:
+            self.assertEqual(sorted(set(self._iterationFiles(protMltomo, ext))), [10, 11])
+        self.assertEqual(len([it for it in self._iterationFiles(protMltomo, 'vol') if it == 11]), 2 * 12)
+        self.assertEqual(sorted(os.listdir(protMltomo._getExtraPath('archive'))),
+                         ['mltomo_it000000.tar.gz', 'mltomo_it000005.tar.gz'])
+        with tarfile.open(protMltomo._getExtraPath('archive', 'mltomo_it000005.tar.gz')) as tar:
+            names = tar.getnames()
+        self.assertIn('mltomo_it000005.doc', names)
+        self.assertIn('mltomo_it000005_ref000012.vol', names)
+        self.assertIn('mltomo_it000005_wedge000012.vol', names)
+
+    def test_compaction(self):
+        protMltomo = self._runMltomo('compaction', compactIterations=True)
+        self._checkOutputs(protMltomo, 3)
+        # The references of the last iteration are kept to continue the run
+        self.assertEqual(sorted(set(self._iterationFiles(protMltomo, 'vol'))), [3])
+        self.assertEqual(self._iterationFiles(protMltomo, 'doc'), [1, 2, 3])
+        self.assertEqual(protMltomo._getVolumeHistory().getIterations(), [0, 1, 2])
+        protMltomo._createFilenameTemplates()
+        self.assertEqual(protMltomo._getLastIteration(), 3)
+        protMltomo.numberOfIters.set(4)
+        protMltomo.runMode.set(MODE_RESUME)
+        self.launchProtocol(protMltomo)
+        self._checkOutputs(protMltomo, 4)
+        self.assertEqual(protMltomo._getVolumeHistory().getIterations(), [0, 1, 2, 3])
+
+    def test_compactionCleaned(self):
+        protMltomo = self._runMltomo('compaction and clean', compactIterations=True, cleanFiles=True)
+        self._checkOutputs(protMltomo, 3)
+        # Only the docfile and the class sel files of the last iteration are kept
+        self.assertEqual([os.path.basename(fn) for _, _, _, _, fn in protMltomo._iterIterationFiles()],
+                         ['mltomo_it000003.doc'] + ['mltomo_it000003_ref%06d.sel' % classSubtomo.getObjId()
+                                                    for classSubtomo in protMltomo.outputClassesSubtomo])
+        for classSubtomo in protMltomo.outputClassesSubtomo:
+            self.assertTrue(os.path.exists(classSubtomo.getRepresentative().getFileName()))
+        # The files are counted for the outermost steps only, the cleaning is nested in createOutput
+        stepStats = {stats['step']: stats for stats in protMltomo._loadStepStats()}
+        self.assertIsNone(stepStats['_cleanFiles']['newFiles'])
+        self.assertLess(stepStats['createOutput']['newFiles'], 0)
+        self.assertTrue(any(line.startswith("Process peak RSS") for line in protMltomo.summary()))
+        # The metrics can be rebuilt from the docfile that is kept
+        metrics = protMltomo._loadMetrics()
+        os.remove(protMltomo._getExtraPath('mltomo_metrics.json'))
+        protMltomo._createFilenameTemplates()
+        protMltomo._updateMetrics(0)
+        rebuilt = protMltomo._loadMetrics()
+        self.assertEqual([stats['iteration'] for stats in rebuilt], [3])
+        self.assertEqual(rebuilt[0]['occupancy'], metrics[-1]['occupancy'])
+
+    def test_schedule(self):
+        protMltomo = self._runMltomo('schedule', numberOfIters=4, doSchedule=True, stageAngularSampling='15 10',
+                                     stageDownscDim='8 10')
+        self._checkOutputs(protMltomo, 4)
+        self.assertEqual([protMltomo._getIterationAngularSampling(it) for it in range(1, 5)], [15, 15, 10, 10])
+        self.assertTrue(os.path.exists(protMltomo._getExtraPath('stage02', 'references.sel')))
+        self.assertTrue(any(line.startswith("Stage 2: iterations 3-4") for line in protMltomo.summary()))
+
+    def test_downscale(self):
+        # With -dim alone MLTomo writes the references at the input size, pre-downscaled
+        # volumes give references at the downscaled size
+        ih = ImageHandler()
+        for preDownscale, dim, samplingRate in [(False, 10, 5.), (True, 8, 6.25)]:
+            protMltomo = self._runMltomo('downscale %s' % preDownscale, numberOfIters=1, downscDim=8,
+                                         preDownscale=preDownscale)
+            representative = protMltomo.outputClassesSubtomo.getFirstItem().getRepresentative()
+            self.assertAlmostEqual(representative.getSamplingRate(), samplingRate)
+            self.assertEqual(ih.getDimensions(representative.getFileName())[0], dim)
+
+    def test_localRefinement(self):
+        # The local refinement starts from the alignment of a previous run
+        protAlign = self._runMltomo('alignment', numberOfIters=1)
+        protMltomo = self._runMltomo('local refinement', numberOfIters=2, localRefinement=True,
+                                     localAngularRange=2, localShiftRange=3,
+                                     inputVolumes=protAlign.outputSubtomograms)
+        self._checkOutputs(protMltomo, 2)
+        with open(protMltomo.getStdoutLog()) as fhLog:
+            self.assertIn('-ang_search 2.0 -limit_trans 3.0', fhLog.read())
+        inputMatrices = {item.getObjId(): item.getTransform().getMatrix() for item in protAlign.outputSubtomograms}
+        for item in protMltomo.outputSubtomograms:
+            self.assertTrue(item.hasTransform())
+            matrix, inputMatrix = item.getTransform().getMatrix(), inputMatrices[item.getObjId()]
+            # The orientations are searched around those of the input, the shifts are kept by the mock
+            angle = np.rad2deg(np.arccos(np.clip((np.trace(matrix[:3, :3].T @ inputMatrix[:3, :3]) - 1) / 2, -1, 1)))
+            self.assertLess(angle, 20)
+            self.assertTrue(np.allclose(matrix[:3, 3], inputMatrix[:3, 3], atol=1e-3))
+
+    def test_unassigned(self):
+        # The subtomograms without class in the docfile are left out of the outputs
+        os.environ['XMIPP2_MOCK_UNASSIGNED'] = '2'
+        try:
+            protMltomo = self._runMltomo('unassigned', numberOfIters=1)
+        finally:
+            del os.environ['XMIPP2_MOCK_UNASSIGNED']
+        self.assertSetSize(protMltomo.outputSubtomograms, 10)
+        self.assertEqual(sum(classSubtomo.getSize() for classSubtomo in protMltomo.outputClassesSubtomo), 10)
+        self.assertTrue(all(item.hasTransform() for item in protMltomo.outputSubtomograms))
+        self.assertEqual(protMltomo.missingItems.get(), 2)
+        self.assertTrue(any(line.startswith("*2* subtomograms missing") for line in protMltomo.summary()))
+
+    def test_validateLists(self):
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSchedule=True, stageAngularSampling='15 10', stageIters='2 x')
+        self.assertEqual(protMltomo.validate(), ["Iterations per stage: give integers separated by spaces"])
+        self.assertEqual(protMltomo._getStages(), [])
+        self.assertTrue(protMltomo.summary())
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSweep=True, sweepReferences='2, 4')
+        self.assertEqual(protMltomo.validate(), ["Numbers of references: give integers separated by spaces"])
+        self.assertEqual(protMltomo._getSweepVariants(), [])
+        self.assertTrue(protMltomo.summary())
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSweep=True, sweepDownscDim='8 12')
+        self.assertEqual(protMltomo.validate(), ["Downscaled dimensions: give even dimensions not larger than 10"])
+        # The dimensions of the stages must be even and fit in the input (of 10^3, 8^3 pre-downscaled)
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSchedule=True, stageAngularSampling='15 10', stageDownscDim='7 10')
+        self.assertEqual(protMltomo.validate(), ["Dimension per stage: give even dimensions not larger than 10"])
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSchedule=True, stageAngularSampling='15 10', stageDownscDim='6 10',
+                                      downscDim=8, preDownscale=True)
+        self.assertEqual(protMltomo.validate(), ["Dimension per stage: give even dimensions not larger than 8"])
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      doSchedule=True, stageAngularSampling='15 10', doSweep=True,
+                                      sweepReferences='2 3')
+        self.assertEqual(len(protMltomo.validate()), 1)
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=self.protImport.outputSubTomograms,
+                                      numberOfShards=13)
+        self.assertEqual(protMltomo.validate(), ["There are more shards than subtomograms (12)"])
+
+    def test_shards(self):
+        protMltomo = self._runMltomo('shards', numberOfShards=2)
+        self._checkOutputs(protMltomo, 3)
+        protMltomo._createFilenameTemplates()
+        for it in [2, 3]:
+            self.assertEqual(protMltomo._countEntries(protMltomo._getFileName('iterDoc', iter=it)), 12)
+            self.assertTrue(os.path.exists(protMltomo._getFileName('iterFsc', iter=it)))
+        # The monitor records the merged iterations, never the files of a shard
+        self.assertTrue(all(sum(stats['occupancy'].values()) == 12 for stats in protMltomo._loadMetrics()))
+        iterations, _, fsc = protMltomo._loadFscHistory()
+        self.assertEqual(iterations.tolist(), [1, 2, 3])
+        self.assertEqual(fsc.shape[1], 2)
+        self.assertTrue(os.path.exists(protMltomo._getExtraPath('shards', 'shard002')))
+
+    def test_sweep(self):
+        protMltomo = self._runMltomo('sweep', numberOfIters=2, doSweep=True, sweepReferences='2 3',
+                                     sweepAngularSampling='15 10', numberOfMpi=2, sweepMpi=1)
+        results = protMltomo._loadSweepResults()
+        self.assertEqual(sorted((result['numberOfReferences'], result['angularSampling']) for result in results),
+                         [(2, 10), (2, 15), (3, 10), (3, 15)])
+        self.assertTrue(all(sum(result['occupancy'].values()) == 12 for result in results))
+
+    def test_sweepVariants(self):
+        protMltomo = self._newMltomo('sweep variants', numberOfIters=1, angularSampling=20, doSweep=True,
+                                     sweepReferences='2 3', sweepDownscDim='8', numberOfMpi=2, sweepMpi=1)
+        # The lists left empty take the value of the form
+        self.assertEqual(protMltomo._getSweepVariants(),
+                         [{'numberOfReferences': 2, 'angularSampling': 20, 'downscDim': 8},
+                          {'numberOfReferences': 3, 'angularSampling': 20, 'downscDim': 8}])
+        # The input is converted once for all the variants
+        protMltomo._insertAllSteps()
+        self.assertEqual([step.funcName.get() for step in protMltomo._steps], ['convertInputStep', 'sweepStep'])
+        variantDir = protMltomo._getExtraPath('variant002')
+        args = protMltomo._getMLTomoArgs(1, 1, variant=protMltomo._getSweepVariants()[1], path=variantDir).split()
+        self.assertEqual(args[args.index('-i') + 1], os.path.join(variantDir, 'subtomograms.sel'))
+        self.assertEqual([args[args.index(arg) + 1] for arg in ['-nref', '-ang', '-dim']], ['3', '20', '8'])
+        protMltomo = self._runMltomo('sweep variants', numberOfIters=1, angularSampling=20, doSweep=True,
+                                     sweepReferences='2 3', sweepDownscDim='8', numberOfMpi=2, sweepMpi=1)
+        protMltomo._createFilenameTemplates()
+        self.assertTrue(os.path.samefile(protMltomo._getExtraPath('variant002', 'subtomograms.sel'),
+                                         protMltomo._getFileName('inputSel')))
+        results = protMltomo._loadSweepResults()
+        self.assertEqual([(result['variant'], result['numberOfReferences']) for result in results], [(1, 2), (2, 3)])
+        self.assertTrue(all(result['runtime'] > 0 for result in results))
+        summary = protMltomo.summary()
+        self.assertIn("Sweep: *2* of *2* variants completed", summary)
+        self.assertTrue(any(line.startswith("Variant 2: references 3, sampling 20, dim 8") for line in summary))
+
+    def test_streaming(self):
+        protMltomo = self._runMltomo('streaming', doStreaming=True, streamingBatchSize=5, streamingIters=2,
+                                     streamingSleepOnWait=1)
+        self._checkStreaming(protMltomo)
+        # A restarted run classifies all the subtomograms again
+        protMltomo.runMode.set(MODE_RESTART)
+        self.launchProtocol(protMltomo)
+        self._checkStreaming(protMltomo)
+
+    def test_streamingGrowingInput(self):
+        # The input is open with 5 subtomograms, the rest arrive while the protocol waits
+        protImport = self.newProtocol(ProtImportSubTomograms, filesPath=self.getOutputPath('subtomograms'),
+                                      filesPattern='subtomo0[0-4].mrc', samplingRate=5, objLabel='growing input')
+        self.launchProtocol(protImport)
+        inputSet = SetOfSubTomograms(filename=protImport.outputSubTomograms.getFileName())
+        inputSet.loadAllProperties()
+        inputSet.setStreamState(Set.STREAM_OPEN)
+        inputSet.write()
+        protMltomo = self.newProtocol(Xmipp2ProtMLTomo, inputVolumes=protImport.outputSubTomograms,
+                                      objLabel='streaming growing input', numberOfReferences=2, numberOfMpi=1,
+                                      doStreaming=True, streamingBatchSize=5, streamingIters=1,
+                                      streamingSleepOnWait=1)
+        self.proj.launchProtocol(protMltomo, wait=False)
+        self._waitFor(lambda: os.path.exists(protMltomo._getExtraPath('round001', 'mltomo_ref000001.vol')))
+        inputSet.enableAppend()
+        for item in self.protImport.outputSubTomograms.iterItems(where='id > 5'):
+            item.setObjId(None)
+            inputSet.append(item)
+        inputSet.setStreamState(Set.STREAM_CLOSED)
+        inputSet.write()
+        inputSet.close()
+        self._waitFor(lambda: self.proj._updateProtocol(protMltomo) is not None and not protMltomo.isActive())
+        self.assertTrue(protMltomo.isFinished())
+        # The new subtomograms are classified in rounds of the batch size
+        self.assertEqual([protMltomo._countEntries(protMltomo._getExtraPath('round%03d' % roundNumber,
+                                                                            'subtomograms.sel'))
+                          for roundNumber in [1, 2, 3]], [5, 5, 2])
+        self.assertEqual([item.getObjId() for item in protMltomo.outputSubtomograms], list(range(1, 13)))
+        self.assertEqual(protMltomo.streamingRound.get(), 3)
+        self.assertEqual(protMltomo.outputSubtomograms.getStreamState(), Set.STREAM_CLOSED)
+
+    @staticmethod
+    def _waitFor(condition, timeout=300):
+        endTime = time.time() + timeout
+        while not condition():
+            if time.time() > endTime:
+                raise AssertionError("Timeout waiting for the protocol")
+            time.sleep(1)
+
+    def test_streamingUnassigned(self):
+        # The streamed subtomograms without class are not appended without alignment
+        os.environ['XMIPP2_MOCK_UNASSIGNED'] = '1'
+        try:
+            protMltomo = self._runMltomo('streaming unassigned', doStreaming=True, streamingBatchSize=5,
+                                         streamingIters=1, streamingSleepOnWait=1)
+        finally:
+            del os.environ['XMIPP2_MOCK_UNASSIGNED']
+        # The first subtomogram of each of the 3 rounds is left out
+        self.assertEqual([item.getObjId() for item in protMltomo.outputSubtomograms],
+                         [2, 3, 4, 5, 7, 8, 9, 10, 12])
+        self.assertTrue(all(item.hasTransform() for item in protMltomo.outputSubtomograms))
+        self.assertEqual(sum(classSubtomo.getSize() for classSubtomo in protMltomo.outputClassesSubtomo), 9)
+        self.assertEqual(protMltomo.missingItems.get(), 3)
+
+    def _checkStreaming(self, protMltomo):
+        self.assertSetSize(protMltomo.outputSubtomograms, 12)
+        self.assertEqual(sum(classSubtomo.getSize() for classSubtomo in protMltomo.outputClassesSubtomo), 12)
+        self.assertEqual(protMltomo.streamingRound.get(), 3)
+        self.assertEqual(protMltomo.lastStreamedId.get(), 12)
+        self.assertEqual(protMltomo.outputSubtomograms.getStreamState(), Set.STREAM_CLOSED)
+        self.assertIn("in *6* iterations", protMltomo.summary()[0])
@@ -30,11 +30,12 @@ This module implements visualization program
 for ml_tomo.
 """
 import os
+import numpy as np
 from xmipp2.protocols import Xmipp2ProtMLTomo
+from xmipp2.convert import fscResolution
 from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO, ProtocolViewer
-from pyworkflow.protocol.params import LabelParam
+from pyworkflow.protocol.params import LabelParam, IntParam, FloatParam, StringParam
 from pwem.viewers.plotter import EmPlotter
-from pwem.viewers.views import DataView
 
 
 class Xmipp2ProtMlTomoViewer(ProtocolViewer):
@@ -47,36 +48,110 @@ class Xmipp2ProtMlTomoViewer(ProtocolViewer):
 
     def _defineParams(self, form):
         form.addSection(label='Resolution')
+        form.addParam('iterationToShow', IntParam, label='Iteration', allowsNull=True,
+                      help="Iteration whose FSC is displayed, the last one if empty")
+        form.addParam('classesToShow', StringParam, label='Classes', default='',
+                      help="Space separated classes (references) to display, all of them if empty")
+        form.addParam('fscThreshold', FloatParam, label='FSC threshold', default=0.5,
+                      help="The resolution is the frequency at which the FSC drops below this value")
         form.addParam('doShowFsc', LabelParam,
                       label="Display Fourier Shell Correlation")
+        form.addParam('doShowResolution', LabelParam,
+                      label="Display resolution per iteration")
+        form.addSection(label='Convergence')
+        form.addParam('doShowConvergence', LabelParam,
+                      label="Display convergence per iteration",
+                      help="Class occupancy, mean log-likelihood, Pmax/sumP and fraction of particles that "
+                           "changed class or orientation (by more than the angular sampling) in each iteration")
 
     def _getVisualizeDict(self):
-        return {'doShowFsc': self._viewFsc}
+        return {'doShowFsc': self._viewFsc,
+                'doShowResolution': self._viewResolution,
+                'doShowConvergence': self._viewConvergence}
 
     def _viewFsc(self, e=None):
-        return self._loadPlots("Fourier Shell Correlation", 'FSC', color='r')
+        iterations, freq, fsc = self._loadFsc()
+        if not len(iterations):
+            return [self._missingFsc()]
+        it = self.iterationToShow.get() or iterations[-1]
+        if it not in iterations:
+            return [self.errorMessage('There is no FSC of iteration %d\n' % it, title='Missing result file')]
+        i = np.flatnonzero(iterations == it)[0]
+        samplingRate = self.protocol._getIterationSamplingRate(it)
+        plotter = EmPlotter(windowTitle="FSC")
+        a = plotter.createSubPlot("Fourier Shell Correlation, iteration %d" % it, "Frequency (1/A)", "FSC")
+        for ref in self._getClasses(fsc.shape[1]):
+            valid = ~np.isnan(fsc[i, ref - 1])
+            a.plot(freq[i][valid] / samplingRate, fsc[i, ref - 1][valid], label="Class %d" % ref)
+        a.axhline(self.fscThreshold.get(), color='k', linestyle='--', linewidth=0.5)
+        plotter.legend()
+        return [plotter]
 
-    def _loadPlots(self, title, plotLabel, **kwargs):
-        """ Check if the FSC metadata is generated and if so,
-        read the plots and the metadata.
-        *args and **kwargs will be passed to self._createPlot function.
-        """
-        fnFsc = self.protocol._getExtraPath("mltomo.fsc")
+    def _viewResolution(self, e=None):
+        iterations, freq, fsc = self._loadFsc()
+        if not len(iterations):
+            return [self._missingFsc()]
+        # (I,R) resolution in A from the digital frequencies
+        resolution = fscResolution(freq[:, None, :], fsc, self.fscThreshold.get())
+        samplingRates = np.array([self.protocol._getIterationSamplingRate(it) for it in iterations.tolist()])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resolution = samplingRates[:, None] / resolution
+        plotter = EmPlotter(windowTitle="Resolution")
+        a = plotter.createSubPlot("Resolution (FSC = %0.2f)" % self.fscThreshold.get(), "Iteration",
+                                  "Resolution (A)")
+        for ref in self._getClasses(fsc.shape[1]):
+            a.plot(iterations, resolution[:, ref - 1], marker='o', label="Class %d" % ref)
+        plotter.legend()
+        return [plotter]
 
-        if not os.path.exists(fnFsc):
-            return [self.errorMessage('The FSC file was not produced\n',
-                                      title='Missing result file')]
-        # leer archivo FSC
-        fnFsc = open(self.protocol._getExtraPath("mltomo.fsc"),'r')
-        lines = fnFsc.readlines()
-        freq = []
-        # fnClasses = self.protocol._getExtraPath("Classes") # generated classes
-        classes = [] # j,i (j num classes, i num lines)
-        for i in lines:
-            freq.append(i.split()) # column frecs
-            # classes.append(i.split()[j]) # j num class
+    def _viewConvergence(self, e=None):
+        metrics = self._loadMetrics()
+        if not metrics:
+            return [self.errorMessage('The iteration docfiles were not produced\n', title='Missing result file')]
+        iterations = [stats['iteration'] for stats in metrics]
 
-        fnFsc.close()
+        def values(key, default=np.nan):
+            return [stats.get(key, default) for stats in metrics]
 
-        plotter = EmPlotter(self, freq, classes[1], title, **kwargs) # change class index
-        return [plotter, DataView(plotLabel)]
\ No newline at end of file
+        plotter = EmPlotter(x=2, y=2, windowTitle="Convergence")
+        a = plotter.createSubPlot("Class occupancy", "Iteration", "Particles")
+        refs = sorted({ref for stats in metrics for ref in stats['occupancy']}, key=int)
+        for ref in refs:
+            a.plot(iterations, [stats['occupancy'].get(ref, 0) for stats in metrics], marker='.',
+                   label="Class %s" % ref)
+        if len(refs) <= 10:
+            plotter.legend()
+        a = plotter.createSubPlot("Mean log-likelihood", "Iteration", "LL")
+        a.plot(iterations, values('meanLL'), marker='.')
+        a = plotter.createSubPlot("Pmax/sumP", "Iteration", "Pmax/sumP")
+        pmax = np.array([[stats['pmax'][key] for key in ['q1', 'median', 'q3']] for stats in metrics])
+        a.fill_between(iterations, pmax[:, 0], pmax[:, 2], alpha=0.3)
+        a.plot(iterations, pmax[:, 1], marker='.', label="Median")
+        a = plotter.createSubPlot("Changes from the previous iteration", "Iteration", "Fraction of particles")
+        a.plot(iterations, values('changedClass'), marker='.', label="Class")
+        a.plot(iterations, values('changedOrientation'), marker='.', label="Orientation")
+        a.set_ylim(0, 1)
+        plotter.legend()
+        plotter.getFigure().tight_layout()
+        return [plotter]
+
+    def _loadMetrics(self):
+        """ Per iteration statistics of the protocol, updated with the iterations that are not
+        recorded yet. Each docfile is parsed only once, when its iteration is recorded. """
+        self.protocol._createFilenameTemplates()
+        fnInputDoc = self.protocol._getFileName('inputDoc')
+        if os.path.exists(fnInputDoc):
+            self.protocol._updateMetrics(os.path.getmtime(fnInputDoc))
+        return self.protocol._loadMetrics()
+
+    def _loadFsc(self):
+        """ FSC of all the iterations, parsed once and cached by the protocol. """
+        self.protocol._createFilenameTemplates()
+        return self.protocol._loadFscHistory()
+
+    def _getClasses(self, numberOfRefs):
+        classes = [int(value) for value in self.classesToShow.get().split()] or range(1, numberOfRefs + 1)
+        return [ref for ref in classes if 1 <= ref <= numberOfRefs]
+
+    def _missingFsc(self):
+        return self.errorMessage('The FSC files were not produced\n', title='Missing result file')
@@ -34,4 +34,23 @@ import pyworkflow as pw
 from pwem.wizards import EmWizard
 from pwem.viewers import CoordinatesObjectView
 from pyworkflow.utils import makePath, cleanPath, readProperties
+from pyworkflow.gui.dialog import showInfo
+
+from .convert import getDownscaledDim
+from .protocols import Xmipp2ProtMLTomo
+
+
+class Xmipp2MLTomoDownscDimWizard(EmWizard):
+    """ Suggest the downscaled dimension of MLTomo from the sampling rate of the input and
+    the target resolution. """
+    _targets = [(Xmipp2ProtMLTomo, ['downscDim'])]
+
+    def show(self, form, *args):
+        protocol = form.protocol
+        inputVols = protocol.inputVolumes.get()
+        if inputVols is None or not protocol.targetResolution.get():
+            showInfo("Downscaled dimension", "Select the input volumes and a target resolution first.", form.root)
+            return
+        form.setVar('downscDim', getDownscaledDim(inputVols.getDim()[0], inputVols.getSamplingRate(),
+                                                  protocol.targetResolution.get()))
 